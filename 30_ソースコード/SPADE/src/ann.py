@@ -0,0 +1,166 @@
+import os
+import torch
+
+from coreset import coreset_size, patch_coreset
+from distance import knn, sq_dist
+from feature_cache import as_tensor, bank_digest
+
+
+class IVFIndex:
+    """Inverted-file approximate nearest neighbour index in pure torch
+
+    Vectors are clustered with k-means into n_lists coarse cells. A query only scans
+    the members of its n_probe closest cells, so n_probe trades recall for speed:
+    n_probe == n_lists is an exact search.
+    """
+
+    VERSION = 1
+
+    def __init__(self, n_lists=256, n_probe=8, n_iter=10, sample_size=65536, seed=0):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_iter = n_iter
+        self.sample_size = sample_size
+        self.seed = seed
+        self.centroids = None
+        self.data = None
+        self.ids = None
+        self.offsets = None
+        # digest of the bank the index was built from, see feature_cache.bank_digest
+        self.digest = None
+
+    def __len__(self):
+        return 0 if self.data is None else self.data.size(0)
+
+    def train(self, x):
+        """Fit the coarse quantizer with k-means on a random sample of x"""
+        generator = torch.Generator().manual_seed(self.seed)
+        if x.size(0) > self.sample_size:
+            x = x[torch.randperm(x.size(0), generator=generator)[:self.sample_size].to(x.device)]
+        x = x.float()
+        n_lists = min(self.n_lists, x.size(0))
+        centroids = x[torch.randperm(x.size(0), generator=generator)[:n_lists].to(x.device)].clone()
+        for _ in range(self.n_iter):
+            _, assign = knn(x, centroids, k=1)
+            assign = assign.squeeze(1)
+            sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+            counts = torch.bincount(assign, minlength=n_lists)
+            # reseed empty cells with random points
+            empty = counts == 0
+            if empty.any():
+                reseed = torch.randint(x.size(0), (int(empty.sum()),), generator=generator).to(x.device)
+                sums[empty] = x[reseed]
+                counts[empty] = 1
+            centroids = sums / counts.unsqueeze(1).to(sums)
+        self.n_lists = n_lists
+        self.centroids = centroids
+        return self
+
+    def add(self, x):
+        """Assign x to its cells and store it grouped by cell"""
+        _, assign = knn(x.float(), self.centroids.to(x.device), k=1)
+        assign = assign.squeeze(1)
+        order = torch.argsort(assign)
+        counts = torch.bincount(assign, minlength=self.n_lists)
+        self.data = x[order]
+        self.ids = order
+        self.offsets = torch.cat([counts.new_zeros(1), torch.cumsum(counts, 0)]).tolist()
+        return self
+
+    def search(self, queries, k, n_probe=None):
+        """Approximate k nearest stored vectors for each query, as (distances, ids) sorted ascending"""
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        device = self.data.device
+        queries = queries.to(device=device, dtype=torch.float32)
+        n = queries.size(0)
+        values = queries.new_full((n, k), float('inf'))
+        indexes = torch.full((n, k), -1, dtype=torch.long, device=device)
+
+        _, probes = knn(queries, self.centroids.to(device), k=n_probe)
+        probe_lists = probes.flatten()
+        probe_queries = torch.arange(n, device=device).repeat_interleave(probes.size(1))
+        order = torch.argsort(probe_lists)
+        probe_lists, probe_queries = probe_lists[order], probe_queries[order]
+        lists, counts = torch.unique_consecutive(probe_lists, return_counts=True)
+
+        start = 0
+        for cell, count in zip(lists.tolist(), counts.tolist()):
+            query_ids = probe_queries[start:start + count]
+            start += count
+            begin, end = self.offsets[cell], self.offsets[cell + 1]
+            if begin == end:
+                continue
+            dist = sq_dist(queries[query_ids], self.data[begin:end].float())
+            cell_values, cell_indexes = torch.topk(dist, k=min(k, end - begin), dim=1, largest=False)
+            # merge the cell into the running top-k of its queries
+            merged_values = torch.cat([values[query_ids], cell_values], 1)
+            merged_indexes = torch.cat([indexes[query_ids], self.ids[begin + cell_indexes]], 1)
+            merged_values, merge_order = torch.topk(merged_values, k=k, dim=1, largest=False)
+            values[query_ids] = merged_values
+            indexes[query_ids] = torch.gather(merged_indexes, 1, merge_order)
+        return values.sqrt_(), indexes
+
+    def state_dict(self):
+        return {'version': self.VERSION, 'n_lists': self.n_lists, 'n_probe': self.n_probe,
+                'n_iter': self.n_iter, 'sample_size': self.sample_size, 'seed': self.seed,
+                'centroids': self.centroids, 'data': self.data, 'ids': self.ids, 'offsets': self.offsets,
+                'digest': self.digest}
+
+    def save(self, path):
+        torch.save(self.state_dict(), path)
+
+    @classmethod
+    def load(cls, path, map_location='cpu'):
+        return cls.from_state_dict(torch.load(path, map_location=map_location), path)
+
+    @classmethod
+    def from_state_dict(cls, state, path=None):
+        if state.get('version') != cls.VERSION:
+            raise ValueError('unsupported index version in %s: %s' % (path, state.get('version')))
+        index = cls(n_lists=state['n_lists'], n_probe=state['n_probe'], n_iter=state['n_iter'],
+                    sample_size=state['sample_size'], seed=state['seed'])
+        index.centroids = state['centroids']
+        index.data = state['data']
+        index.ids = state['ids']
+        index.offsets = state['offsets']
+        index.digest = state.get('digest')
+        return index
+
+
+def patch_bank(feat_map):
+    """Flatten (N, C, H, W) feature maps into a (N * H * W, C) bank of patch features"""
+    return feat_map.permute(0, 2, 3, 1).reshape(-1, feat_map.size(1))
+
+
+def build_patch_indexes(train_outputs, layer_names, n_lists=256, n_probe=8, index_path=None, device='cpu',
+                        coreset=None):
+    """IVF index over all train patches of each layer, loaded from index_path % layer_name if present
+
+    If coreset is given, the index only holds a greedy k-center subset of the patches
+    (see coreset.coreset_size for its meaning). A saved index is only reused if it was
+    built from a bank with the same content digest and the same coreset.
+    """
+    digest = '%s_%s' % (bank_digest(train_outputs), coreset)
+    indexes = {}
+    for layer_name in layer_names:
+        filepath = index_path % layer_name if index_path is not None else None
+        if filepath is not None and os.path.exists(filepath):
+            index = IVFIndex.load(filepath, map_location=device)
+            n, _, h, w = train_outputs[layer_name].shape
+            n_patches = n * h * w
+            if coreset is not None:
+                n_patches = coreset_size(n_patches, coreset)
+            if index.digest == digest and index.n_lists == min(n_lists, n_patches) and len(index) == n_patches:
+                print('load %s patch index from: %s' % (layer_name, filepath))
+                index.n_probe = n_probe
+                indexes[layer_name] = index
+                continue
+        bank = patch_bank(as_tensor(train_outputs[layer_name], device))
+        if coreset is not None:
+            bank = patch_coreset(bank, coreset)
+        index = IVFIndex(n_lists=n_lists, n_probe=n_probe).train(bank).add(bank)
+        index.digest = digest
+        if filepath is not None:
+            index.save(filepath)
+        indexes[layer_name] = index
+    return indexes
@@ -0,0 +1,109 @@
+import argparse
+import json
+import os
+import platform
+import tempfile
+
+import numpy as np
+import torch
+from torchvision.models import wide_resnet50_2
+
+import datasets.mvtec as mvtec
+from datasets.synthetic import make_synthetic_mvtec
+from detector import SpadeDetector
+from distance import knn
+from extractor import build_extractor
+from feature_cache import as_tensor
+from localization import iter_layer_score_maps
+from metrics import HistogramScoreAccumulator, ScoreAccumulator
+from postprocess import postprocess
+from profiler import StageProfiler
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('SPADE benchmark')
+    parser.add_argument("--root_path", type=str, default=None, help='where synthetic datasets are written '
+                                                                    '(default: a temporary directory)')
+    parser.add_argument("--class_name", type=str, default='bottle')
+    parser.add_argument("--n_train", type=int, nargs='+', default=[20])
+    parser.add_argument("--n_test", type=int, nargs='+', default=[20], help='half good, half defective')
+    parser.add_argument("--top_k", type=int, default=5)
+    parser.add_argument("--memory_budget_mb", type=int, default=512)
+    parser.add_argument("--random_weights", action='store_true', help='do not download pretrained weights')
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--output", type=str, default='./result/benchmark.json')
+    return parser.parse_args()
+
+
+def run_benchmark(root_path, class_name, n_train, n_test, args, device, extractor):
+    """Stage timings of one SPADE run on a synthetic dataset with n_train / n_test images"""
+    if not os.path.exists(os.path.join(root_path, 'mvtec_anomaly_detection', class_name)):
+        make_synthetic_mvtec(root_path, class_name, n_train=n_train, n_test_good=n_test // 2,
+                             n_test_defect=n_test - n_test // 2)
+    train_dataset = mvtec.MVTecDataset(root_path=root_path, class_name=class_name, is_train=True)
+    test_dataset = mvtec.MVTecDataset(root_path=root_path, class_name=class_name, is_train=False)
+    detector = SpadeDetector(top_k=args.top_k, memory_budget_mb=args.memory_budget_mb, device=device,
+                             extractor=extractor)
+    labels = np.asarray(test_dataset.y)
+    masks = np.stack([test_dataset[idx][2].numpy() for idx in range(len(test_dataset))])
+    timer = StageProfiler(device)
+
+    for _ in range(args.repeat):
+        with timer.stage('feature_extraction'):
+            detector.train_outputs = detector.extract_dataset(train_dataset, '| benchmark | train | %s |' % class_name)
+            test_outputs = detector.extract_dataset(test_dataset, '| benchmark | test | %s |' % class_name)
+
+        with timer.stage('image_knn'):
+            topk_values, topk_indexes = knn(torch.flatten(test_outputs['avgpool'], 1).to(device),
+                                            torch.flatten(as_tensor(detector.train_outputs['avgpool'], device), 1),
+                                            k=detector.top_k, row_tile=detector.tile_size,
+                                            col_tile=detector.tile_size)
+            scores = torch.mean(topk_values, 1).cpu().numpy()
+
+        with timer.stage('localization'):
+            layer_score_maps = list(iter_layer_score_maps(test_outputs, detector.train_outputs, topk_indexes,
+                                                          memory_budget_mb=detector.memory_budget_mb))
+
+        with timer.stage('smoothing'):
+            score_maps = np.concatenate([postprocess(maps).cpu().numpy() for maps in layer_score_maps])
+
+        with timer.stage('metrics'):
+            img_metric = ScoreAccumulator()
+            img_metric.update(labels, scores)
+            pixel_metric = HistogramScoreAccumulator()
+            pixel_metric.update(masks, score_maps)
+            roc_auc, pixel_roc_auc = img_metric.roc_auc(), pixel_metric.roc_auc()
+            pixel_metric.best_f1_threshold()
+
+    return {'n_train': n_train, 'n_test': n_test, 'repeat': args.repeat,
+            'seconds': {name: t / args.repeat for name, t in timer.wall_times().items()},
+            'stages': timer.summary(),
+            'roc_auc': roc_auc, 'pixel_roc_auc': pixel_roc_auc}
+
+
+def main():
+    args = parse_args()
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model = wide_resnet50_2(pretrained=not args.random_weights, progress=True)
+    extractor = build_extractor(device, model=model)
+    root = args.root_path or tempfile.mkdtemp(prefix='spade_benchmark_')
+
+    results = []
+    for n_train in args.n_train:
+        for n_test in args.n_test:
+            root_path = os.path.join(root, 'train%d_test%d' % (n_train, n_test))
+            result = run_benchmark(root_path, args.class_name, n_train, n_test, args, device, extractor)
+            print(json.dumps(result))
+            results.append(result)
+
+    report = {'device': device, 'torch': torch.__version__, 'threads': torch.get_num_threads(),
+              'platform': platform.platform(), 'top_k': args.top_k, 'memory_budget_mb': args.memory_budget_mb,
+              'random_weights': args.random_weights, 'results': results}
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('benchmark results saved to: %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
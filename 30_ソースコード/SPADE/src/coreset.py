@@ -0,0 +1,62 @@
+from collections import OrderedDict
+
+import torch
+
+from distance import sq_dist
+from feature_cache import as_tensor
+
+
+def coreset_size(n, size):
+    """Number of samples to keep out of n: size <= 1 is a ratio, size > 1 an absolute count"""
+    if size <= 1:
+        return max(1, int(round(n * size)))
+    return min(n, int(size))
+
+
+def greedy_coreset(x, n, projection_dim=128, seed=0, max_steps=None):
+    """Indexes of n rows of x (N, d) selected by greedy k-center
+
+    Each step adds the rows farthest from the current selection. Distances are
+    computed on a random Gaussian projection of x to projection_dim dimensions.
+    Every step is one pass over all N rows on the device of x, so an exact run costs
+    n passes. With max_steps, ceil(n / max_steps) rows are added per step (the
+    farthest ones), which bounds the cost to max_steps passes at the price of
+    sometimes selecting rows close to each other within one step.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    x = x.float()
+    if projection_dim is not None and projection_dim < x.size(1):
+        projection = torch.randn(x.size(1), projection_dim, generator=generator) / projection_dim ** 0.5
+        x = x @ projection.to(x.device)
+
+    n = min(n, x.size(0))
+    per_step = 1 if max_steps is None else max(1, -(-n // max_steps))
+    x_sq = x.pow(2).sum(1)
+    selected = torch.randint(x.size(0), (1,), generator=generator).to(x.device)
+    # selected rows get distance 0, so they are not picked again
+    min_dist = sq_dist(x, x[selected], x_sq, x_sq[selected]).squeeze(1)
+    min_dist[selected] = 0
+    chunks = [selected]
+    n_selected = 1
+    while n_selected < n:
+        selected = torch.topk(min_dist, min(per_step, n - n_selected))[1]
+        min_dist = torch.minimum(min_dist, sq_dist(x, x[selected], x_sq, x_sq[selected]).min(1)[0])
+        min_dist[selected] = 0
+        chunks.append(selected)
+        n_selected += len(selected)
+    return torch.sort(torch.cat(chunks).cpu())[0]
+
+
+def image_coreset(train_outputs, size, device='cpu', **kwargs):
+    """Subset of the train images selected by greedy k-center over their avgpool features"""
+    avgpool = torch.flatten(as_tensor(train_outputs['avgpool'], device), 1)
+    indexes = greedy_coreset(avgpool, coreset_size(avgpool.size(0), size), **kwargs)
+    return OrderedDict((layer_name, feat[indexes.to(feat.device)] if isinstance(feat, torch.Tensor)
+                        else feat[indexes.numpy()])
+                       for layer_name, feat in train_outputs.items())
+
+
+def patch_coreset(bank, size, max_steps=1000, **kwargs):
+    """Subset of a (N, C) patch bank selected by greedy k-center, in at most max_steps passes over the bank"""
+    return bank[greedy_coreset(bank, coreset_size(bank.size(0), size), max_steps=max_steps, **kwargs)
+                .to(bank.device)]
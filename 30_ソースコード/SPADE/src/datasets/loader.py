@@ -0,0 +1,45 @@
+import time
+
+from torch.utils.data import DataLoader
+
+
+def make_dataloader(dataset, batch_size=32, num_workers=0, prefetch_factor=2, pin_memory=True):
+    """DataLoader with parallel, persistent workers and prefetching when num_workers > 0"""
+    kwargs = {}
+    if num_workers > 0:
+        kwargs = dict(persistent_workers=True, prefetch_factor=prefetch_factor)
+    return DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=pin_memory, **kwargs)
+
+
+class ThroughputMeter:
+    """Iterates over a DataLoader while counting images, bytes moved and time spent waiting for input"""
+
+    def __init__(self, dataloader):
+        self.dataloader = dataloader
+        self.images = 0
+        self.bytes = 0
+        self.wait_time = 0.
+        self.total_time = 0.
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        start = time.perf_counter()
+        iterator = iter(self.dataloader)
+        while True:
+            wait_start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                break
+            self.wait_time += time.perf_counter() - wait_start
+            self.images += len(batch[0])
+            self.bytes += sum(t.numel() * t.element_size() for t in batch if hasattr(t, 'element_size'))
+            yield batch
+        self.total_time += time.perf_counter() - start
+
+    def report(self):
+        total_time = max(self.total_time, 1e-9)
+        return '%.1f images/s, %.1f MB moved, %.0f%% of the time waiting for input' % (
+            self.images / total_time, self.bytes / 1024 ** 2, 100 * self.wait_time / total_time)
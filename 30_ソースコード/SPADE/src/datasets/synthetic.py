@@ -0,0 +1,68 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+from datasets.mvtec import hash_files, write_marker
+
+
+DEFECT_TYPES = ['blob', 'scratch']
+
+
+def _background(rng, size):
+    """Smooth textured RGB image, shared structure plus a little per-image noise"""
+    yy, xx = np.mgrid[0:size, 0:size] / size
+    img = np.stack([0.5 + 0.2 * np.sin(2 * np.pi * (xx * 3 + c)) * np.cos(2 * np.pi * yy * 2) for c in range(3)], -1)
+    img += rng.normal(0, 0.03, img.shape)
+    return img
+
+
+def _defect_mask(rng, size, defect_type):
+    yy, xx = np.mgrid[0:size, 0:size]
+    cy, cx = rng.uniform(0.25, 0.75, 2) * size
+    if defect_type == 'blob':
+        ry, rx = rng.uniform(0.04, 0.12, 2) * size
+        return ((yy - cy) / ry) ** 2 + ((xx - cx) / rx) ** 2 <= 1
+    angle = rng.uniform(0, np.pi)
+    dist = np.abs((yy - cy) * np.cos(angle) - (xx - cx) * np.sin(angle))
+    along = np.abs((yy - cy) * np.sin(angle) + (xx - cx) * np.cos(angle))
+    return (dist <= 0.01 * size + 1) & (along <= rng.uniform(0.1, 0.3) * size)
+
+
+def _save_png(array, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.fromarray(array).save(path)
+
+
+def make_synthetic_mvtec(root_path, class_name='bottle', n_train=20, n_test_good=10, n_test_defect=10,
+                         size=256, seed=0):
+    """Write a synthetic class in the MVTec AD folder layout expected by MVTecDataset
+
+    root_path/mvtec_anomaly_detection/<class_name>/{train/good, test/good, test/<defect>,
+    ground_truth/<defect>/<name>_mask.png}. Defects are recolored blobs and scratches.
+    A completion marker is written, so MVTecDataset(root_path=root_path) uses it directly.
+    """
+    rng = np.random.RandomState(seed)
+    class_path = os.path.join(root_path, 'mvtec_anomaly_detection', class_name)
+    assert not os.path.exists(class_path), '{} already exists'.format(class_path)
+
+    def good_image():
+        return (np.clip(_background(rng, size), 0, 1) * 255).astype(np.uint8)
+
+    for idx in range(n_train):
+        _save_png(good_image(), os.path.join(class_path, 'train', 'good', '%03d.png' % idx))
+    for idx in range(n_test_good):
+        _save_png(good_image(), os.path.join(class_path, 'test', 'good', '%03d.png' % idx))
+    for idx in range(n_test_defect):
+        defect_type = DEFECT_TYPES[idx % len(DEFECT_TYPES)]
+        img = _background(rng, size)
+        mask = _defect_mask(rng, size, defect_type)
+        img[mask] = rng.uniform(0, 1, 3)
+        img = (np.clip(img, 0, 1) * 255).astype(np.uint8)
+        name = '%03d' % (idx // len(DEFECT_TYPES))
+        _save_png(img, os.path.join(class_path, 'test', defect_type, name + '.png'))
+        _save_png(mask.astype(np.uint8) * 255, os.path.join(class_path, 'ground_truth', defect_type,
+                                                           name + '_mask.png'))
+
+    write_marker(class_path, hash_files(class_path))
+    return class_path
@@ -0,0 +1,252 @@
+import os
+import shutil
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from ann import build_patch_indexes
+from coreset import image_coreset
+from extractor import build_extractor, extract
+from feature_cache import as_tensor, bank_digest, keys_digest, load_features, load_meta, save_features, update_features
+from image_index import build_image_index, ivf_n_lists, load_image_index, save_image_index
+from localization import LAYER_NAMES, calc_score_maps
+
+
+class SpadeDetector:
+    """SPADE anomaly detector with a fit/predict API
+
+    fit() builds the train feature bank from normal images, predict() returns
+    image-level scores and pixel-level score maps for a batch of normalized images.
+    save()/load() store the bank and the config as one artifact directory, in the
+    feature cache format of feature_cache.py.
+    """
+
+    CONFIG_KEYS = ['top_k', 'memory_budget_mb', 'tile_size', 'cache_dtype', 'dist_dtype', 'coreset',
+                   'image_index', 'image_n_lists', 'ann', 'n_lists', 'n_probe', 'patch_coreset', 'window_radius',
+                   'batch_size', 'compile_mode']
+
+    def __init__(self, top_k=5, memory_budget_mb=512, tile_size=1024, cache_dtype='float32', dist_dtype='float32',
+                 coreset=None, image_index='brute', image_n_lists=None, ann=False, n_lists=256, n_probe=8,
+                 patch_coreset=None, window_radius=None, batch_size=32, compile_mode='none', device=None,
+                 extractor=None, num_workers=0):
+        assert not (ann and window_radius is not None), 'window_radius cannot be combined with ann'
+        self.top_k = top_k
+        self.memory_budget_mb = memory_budget_mb
+        self.tile_size = tile_size
+        self.cache_dtype = cache_dtype
+        self.dist_dtype = dist_dtype
+        self.coreset = coreset
+        self.image_index = image_index
+        self.image_n_lists = image_n_lists
+        self.ann = ann
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.patch_coreset = patch_coreset
+        self.window_radius = window_radius
+        self.batch_size = batch_size
+        self.compile_mode = compile_mode
+        self.device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+        self._extractor = extractor
+        self.num_workers = num_workers
+        self.train_outputs = None
+        self.feature_dir = None
+        self.patch_indexes = None
+        self.avgpool_index = None
+
+    def config(self):
+        return {key: getattr(self, key) for key in self.CONFIG_KEYS}
+
+    @property
+    def extractor(self):
+        if self._extractor is None:
+            self._extractor = build_extractor(self.device, compile_mode=self.compile_mode)
+        return self._extractor
+
+    def extract(self, images):
+        """Layer1-3 and avgpool features of a batch of normalized or uint8 images"""
+        return extract(self.extractor, images.to(self.device, non_blocking=True))
+
+    def iter_extract_dataset(self, dataset, desc=None):
+        """Features of the batches of a dataset yielding (x, y, mask), one OrderedDict on the CPU per batch"""
+        # the loaders and the progress bar are only needed to fit, not to load a detector and predict
+        from tqdm import tqdm
+        from datasets.loader import ThroughputMeter, make_dataloader
+
+        dataloader = ThroughputMeter(make_dataloader(dataset, batch_size=self.batch_size,
+                                                     num_workers=self.num_workers))
+        for (x, y, mask) in tqdm(dataloader, desc):
+            yield OrderedDict((k, v.cpu()) for k, v in self.extract(x).items())
+        if desc is not None:
+            print('%s loader: %s' % (desc, dataloader.report()))
+
+    def extract_dataset(self, dataset, desc=None):
+        """Features of all images of a dataset yielding (x, y, mask), concatenated on the CPU"""
+        outputs = OrderedDict()
+        for batch in self.iter_extract_dataset(dataset, desc):
+            for k, v in batch.items():
+                outputs.setdefault(k, []).append(v)
+        return OrderedDict((k, torch.cat(v, 0)) for k, v in outputs.items())
+
+    def fit(self, dataset, cache_dir=None):
+        """Build the train feature bank from a dataset of normal images
+
+        If cache_dir is given, features are loaded from / saved to the feature cache there,
+        and the coreset bank and ANN indexes are cached next to it. For datasets with
+        image_keys() (MVTecDataset) the cache is content-addressed: only images that
+        are new or changed since the last fit are extracted, removed images are dropped,
+        and the extracted batches are written to the cache as they arrive instead of
+        being concatenated in memory.
+        """
+        from torch.utils.data import Subset
+
+        class_name = getattr(dataset, 'class_name', '')
+        desc = '| feature extraction | train | %s |' % class_name
+        train_outputs = None
+        source = None
+        if cache_dir is not None and hasattr(dataset, 'image_keys'):
+            header = load_meta(cache_dir) or {}
+            files, keys = dataset.image_keys(header.get('files'))
+            train_outputs, _ = update_features(
+                cache_dir, keys, lambda indexes: self.iter_extract_dataset(Subset(dataset, indexes), desc),
+                dtype=self.cache_dtype, files=files, class_name=class_name)
+            source = keys_digest(keys)
+        elif cache_dir is not None:
+            train_outputs = load_features(cache_dir, dtype=self.cache_dtype, class_name=class_name)
+            if train_outputs is not None:
+                print('load train set feature from: %s' % cache_dir)
+        if train_outputs is None:
+            train_outputs = self.extract_dataset(dataset, desc)
+            if cache_dir is not None:
+                save_features(cache_dir, train_outputs, dtype=self.cache_dtype, class_name=class_name)
+                train_outputs = load_features(cache_dir, dtype=self.cache_dtype, class_name=class_name)
+
+        # reduce the train bank to a coreset of train images
+        if self.coreset is not None:
+            full_size = len(train_outputs['avgpool'])
+            coreset_outputs = None
+            if cache_dir is not None:
+                coreset_dir = '%s_coreset_%g' % (cache_dir, self.coreset)
+                coreset_outputs = load_features(coreset_dir, dtype=self.cache_dtype, class_name=class_name,
+                                                coreset=self.coreset, source=source)
+            if coreset_outputs is None:
+                coreset_outputs = image_coreset(train_outputs, self.coreset, device=self.device)
+                if cache_dir is not None:
+                    # drop indexes built on a previous coreset
+                    shutil.rmtree(coreset_dir, ignore_errors=True)
+                    save_features(coreset_dir, coreset_outputs, dtype=self.cache_dtype, class_name=class_name,
+                                  coreset=self.coreset, source=source)
+                    coreset_outputs = load_features(coreset_dir, dtype=self.cache_dtype, class_name=class_name,
+                                                    coreset=self.coreset, source=source)
+            train_outputs = coreset_outputs
+            cache_dir = coreset_dir if cache_dir is not None else None
+            print('%s coreset: %d of %d train images' % (class_name, len(train_outputs['avgpool']), full_size))
+
+        self.train_outputs = train_outputs
+        self.feature_dir = cache_dir
+        self.patch_indexes = self._build_patch_indexes(cache_dir)
+        self.avgpool_index = self._build_image_index(cache_dir)
+        return self
+
+    def _build_patch_indexes(self, index_dir):
+        if not self.ann:
+            return None
+        # the index is saved next to the feature cache of the bank
+        index_path = None
+        if index_dir is not None:
+            index_name = 'ann_%s.pt'
+            if self.patch_coreset is not None:
+                index_name = 'ann_patch_coreset_%g_%%s.pt' % self.patch_coreset
+            index_path = os.path.join(index_dir, index_name)
+        return build_patch_indexes(self.train_outputs, LAYER_NAMES, n_lists=self.n_lists, n_probe=self.n_probe,
+                                   index_path=index_path, device=self.device, coreset=self.patch_coreset)
+
+    def _build_image_index(self, index_dir):
+        """Index over the avgpool features of the bank, loaded from index_dir if it holds one built from this bank
+
+        A saved IVF index is only reused if it has the cells that image_n_lists asks for.
+        """
+        index_path = None
+        digest = bank_digest(self.train_outputs)
+        if index_dir is not None and self.image_index != 'brute':
+            index_path = os.path.join(index_dir, 'image_index_%s.pt' % self.image_index)
+            if os.path.exists(index_path):
+                index = load_image_index(index_path, map_location=self.device)
+                n_train = len(self.train_outputs['avgpool'])
+                if index.digest == digest and len(index) == n_train and (
+                        self.image_index != 'ivf' or index.n_lists == ivf_n_lists(n_train, self.image_n_lists)):
+                    print('load image index from: %s' % index_path)
+                    if self.image_index == 'ivf':
+                        index.n_probe = self.n_probe
+                    return index
+        index = build_image_index(self.image_index, torch.flatten(as_tensor(self.train_outputs['avgpool'],
+                                                                            self.device), 1),
+                                  tile_size=self.tile_size, dtype=self.dist_dtype, n_lists=self.image_n_lists,
+                                  n_probe=self.n_probe)
+        index.digest = digest
+        if index_path is not None:
+            save_image_index(index, index_path)
+        return index
+
+    def image_scores(self, test_outputs):
+        """Image-level scores and the indexes of the top_k nearest train images"""
+        if self.avgpool_index is None:
+            self.avgpool_index = self._build_image_index(None)
+        # select K nearest neighbor and take average
+        queries = torch.flatten(test_outputs['avgpool'], 1).to(self.device)
+        topk_values, topk_indexes = self.avgpool_index.search(queries, self.top_k)
+        missing = topk_indexes < 0
+        if missing.any():
+            # an approximate search can find fewer than top_k neighbours: repeat the nearest one
+            topk_indexes = torch.where(missing, topk_indexes[:, :1], topk_indexes)
+            topk_values = torch.where(missing, topk_values[:, :1], topk_values)
+        return torch.mean(topk_values, 1).cpu().detach().numpy(), topk_indexes
+
+    def score_maps(self, test_outputs, topk_indexes, desc=None):
+        """Pixel-level score maps against the patches of the nearest train images"""
+        return calc_score_maps(test_outputs, self.train_outputs, topk_indexes, memory_budget_mb=self.memory_budget_mb,
+                               patch_indexes=self.patch_indexes, n_probe=self.n_probe, desc=desc,
+                               dtype=getattr(torch, self.dist_dtype), window_radius=self.window_radius)
+
+    def score(self, test_outputs, desc=None):
+        """Image-level scores and pixel-level score maps from extracted test features"""
+        scores, topk_indexes = self.image_scores(test_outputs)
+        return scores, self.score_maps(test_outputs, topk_indexes, desc=desc)
+
+    def predict(self, images):
+        """Image-level scores (N,) and pixel-level score maps (N, H, W) of normalized or uint8 images (N, 3, H, W)"""
+        assert self.train_outputs is not None, 'detector should be fitted or loaded before predict'
+        scores, score_maps = [], []
+        for start in range(0, images.size(0), self.batch_size):
+            batch_scores, batch_score_maps = self.score(self.extract(images[start:start + self.batch_size]))
+            scores.append(batch_scores)
+            score_maps.extend(batch_score_maps)
+        return np.concatenate(scores), np.stack(score_maps)
+
+    def save(self, path):
+        """Save the train feature bank, its ANN indexes and the config to the directory path"""
+        assert self.train_outputs is not None, 'detector should be fitted before save'
+        assert self.feature_dir is None or os.path.abspath(path) != os.path.abspath(self.feature_dir), \
+            'path should differ from the feature cache the detector was fitted from'
+        save_features(path, self.train_outputs, dtype=self.cache_dtype, config=self.config())
+        if self.patch_indexes is not None:
+            for layer_name, index in self.patch_indexes.items():
+                index.save(os.path.join(path, 'ann_%s.pt' % layer_name))
+        if self.avgpool_index is not None and self.image_index != 'brute':
+            save_image_index(self.avgpool_index, os.path.join(path, 'image_index_%s.pt' % self.image_index))
+
+    @classmethod
+    def load(cls, path, device=None, extractor=None, num_workers=0):
+        """Detector saved with save(), with its feature bank memory-mapped"""
+        header = load_meta(path)
+        assert header is not None and 'config' in header, 'no detector saved in {}'.format(path)
+        detector = cls(device=device, extractor=extractor, num_workers=num_workers, **header['config'])
+        detector.train_outputs = load_features(path, dtype=detector.cache_dtype)
+        assert detector.train_outputs is not None, 'feature bank in {} cannot be loaded'.format(path)
+        detector.feature_dir = path
+        if detector.ann:
+            detector.patch_indexes = build_patch_indexes(
+                detector.train_outputs, LAYER_NAMES, n_lists=detector.n_lists, n_probe=detector.n_probe,
+                index_path=os.path.join(path, 'ann_%s.pt'), device=detector.device, coreset=detector.patch_coreset)
+        detector.avgpool_index = detector._build_image_index(path)
+        return detector
@@ -0,0 +1,114 @@
+import torch
+
+
+def batched_sq_dist(x, y, x_sq=None, y_sq=None):
+    """Squared Euclidean distance between (B, n, d) and (B, m, d) via ||x||^2 - 2xy + ||y||^2
+
+    For float16 / bfloat16 inputs the products xy are computed and rounded in that
+    dtype, only the norms and the sum are float32. The sum cancels for near
+    neighbours, so their distances carry the rounding error of the products, which
+    is relative to ||x|| ||y|| (2^-8 for bfloat16, 2^-11 for float16), not to the distance.
+    """
+    if x_sq is None:
+        x_sq = x.float().pow(2).sum(2)
+    if y_sq is None:
+        y_sq = y.float().pow(2).sum(2)
+    if x.dtype == torch.float32:
+        dist = torch.baddbmm(y_sq.unsqueeze(1), x, y.transpose(1, 2), alpha=-2)
+    else:
+        dist = torch.bmm(x, y.transpose(1, 2)).float().mul_(-2).add_(y_sq.unsqueeze(1))
+    dist += x_sq.unsqueeze(2)
+    return dist.clamp_(min=0)
+
+
+def batched_min_dist(x, y, max_elements):
+    """Euclidean distance from each row of x (B, n, d) to its nearest row of y (B, m, d)
+
+    y is processed in column chunks so that no more than max_elements distances
+    are alive at the same time.
+    """
+    b, n, _ = x.shape
+    m = y.size(1)
+    x_sq = x.float().pow(2).sum(2)
+    chunk = max(1, max_elements // max(1, b * n))
+    min_dist = torch.full((b, n), float('inf'), device=x.device)
+    for start in range(0, m, chunk):
+        y_chunk = y[:, start:start + chunk]
+        dist = batched_sq_dist(x, y_chunk, x_sq=x_sq)
+        min_dist = torch.minimum(min_dist, dist.min(2)[0])
+    return min_dist.sqrt_()
+
+
+def windowed_min_dist(x, y, radius):
+    """Euclidean distance from each location of x (B, C, h, w) to its nearest feature in y (B, K, C, h, w)
+
+    Only features of y within radius cells of the same location are compared,
+    one (dy, dx) offset at a time, so the cost is (2 * radius + 1) ** 2 * K
+    comparisons per location instead of K * h * w. Sums are float32.
+    """
+    b, _, h, w = x.shape
+    min_dist = torch.full((b, h, w), float('inf'), device=x.device)
+    x = x.unsqueeze(1)
+    for dy in range(-radius, radius + 1):
+        for dx in range(-radius, radius + 1):
+            # test locations [ys, xs] whose neighbour at (dy, dx) lies inside the map
+            ys = slice(max(0, -dy), min(h, h - dy))
+            xs = slice(max(0, -dx), min(w, w - dx))
+            if ys.start >= ys.stop or xs.start >= xs.stop:
+                continue
+            shifted = y[..., ys.start + dy:ys.stop + dy, xs.start + dx:xs.stop + dx]
+            dist = (x[..., ys, xs] - shifted).float().pow_(2).sum(2).min(1)[0]
+            min_dist[:, ys, xs] = torch.minimum(min_dist[:, ys, xs], dist)
+    return min_dist.sqrt_()
+
+
+def sq_dist(x, y, x_sq=None, y_sq=None):
+    """Squared Euclidean distance between (n, d) and (m, d) via ||x||^2 - 2xy + ||y||^2, see batched_sq_dist"""
+    if x_sq is None:
+        x_sq = x.float().pow(2).sum(1)
+    if y_sq is None:
+        y_sq = y.float().pow(2).sum(1)
+    if x.dtype == torch.float32:
+        dist = torch.addmm(y_sq.unsqueeze(0), x, y.t(), alpha=-2)
+    else:
+        dist = torch.mm(x, y.t()).float().mul_(-2).add_(y_sq.unsqueeze(0))
+    dist += x_sq.unsqueeze(1)
+    return dist.clamp_(min=0)
+
+
+def calc_dist_matrix(x, y, tile_size=1024):
+    """Calculate Euclidean distance matrix with torch.tensor, one row tile at a time"""
+    dist_matrix = torch.empty((x.size(0), y.size(0)), device=x.device)
+    y_sq = y.float().pow(2).sum(1)
+    for start in range(0, x.size(0), tile_size):
+        dist_matrix[start:start + tile_size] = sq_dist(x[start:start + tile_size], y, y_sq=y_sq).sqrt_()
+    return dist_matrix
+
+
+def knn(x, y, k, row_tile=1024, col_tile=1024):
+    """K nearest rows of y for each row of x, as (distances, indexes) sorted ascending
+
+    Distances are computed one (row_tile, col_tile) tile at a time and merged into
+    a running top-k, so peak memory does not depend on the number of rows of y.
+    Distances are float32, the products are computed and rounded in the dtype of x (see batched_sq_dist).
+    """
+    k = min(k, y.size(0))
+    topk_values = torch.empty((x.size(0), k), device=x.device)
+    topk_indexes = torch.empty((x.size(0), k), dtype=torch.long, device=x.device)
+    for row in range(0, x.size(0), row_tile):
+        x_tile = x[row:row + row_tile]
+        x_sq = x_tile.float().pow(2).sum(1)
+        values = torch.empty((x_tile.size(0), 0), device=x.device)
+        indexes = torch.empty((x_tile.size(0), 0), dtype=torch.long, device=x.device)
+        for col in range(0, y.size(0), col_tile):
+            y_tile = y[col:col + col_tile].to(x_tile)
+            dist = sq_dist(x_tile, y_tile, x_sq=x_sq)
+            col_indexes = torch.arange(col, col + y_tile.size(0), device=x.device).expand_as(dist)
+            # merge the tile into the running top-k
+            values = torch.cat([values, dist], 1)
+            indexes = torch.cat([indexes, col_indexes], 1)
+            values, order = torch.topk(values, k=min(k, values.size(1)), dim=1, largest=False)
+            indexes = torch.gather(indexes, 1, order)
+        topk_values[row:row + row_tile] = values.sqrt_()
+        topk_indexes[row:row + row_tile] = indexes
+    return topk_values, topk_indexes
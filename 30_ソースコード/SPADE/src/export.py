@@ -0,0 +1,115 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import torch
+
+from extractor import OUTPUT_NAMES, FeatureExtractor, build_extractor, build_hooked_model, extract, load_extractor
+
+
+# cold start of a fresh process: imports, model construction and the first batch
+COLD_START_HOOKED = '''
+import time
+start = time.perf_counter()
+import torch
+from torchvision.models import wide_resnet50_2
+from extractor import build_hooked_model
+forward = build_hooked_model({device!r}, wide_resnet50_2(pretrained={pretrained!r}))
+forward(torch.zeros({batch_size}, 3, 224, 224, device={device!r}))
+print(time.perf_counter() - start)
+'''
+
+COLD_START_EXPORTED = '''
+import time
+start = time.perf_counter()
+import torch
+from extractor import extract, load_extractor
+extractor = load_extractor({path!r}, {device!r})
+extract(extractor, torch.zeros({batch_size}, 3, 224, 224, device={device!r}))
+print(time.perf_counter() - start)
+'''
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('SPADE feature extractor export')
+    parser.add_argument("--output", type=str, default='./result/extractor.pt', help='.pt (TorchScript) or .onnx')
+    parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument("--batch_size", type=int, default=8, help='batch of the equivalence check and timings')
+    parser.add_argument("--random_weights", action='store_true', help='do not download pretrained weights')
+    parser.add_argument("--atol", type=float, default=1e-3)
+    return parser.parse_args()
+
+
+def export_torchscript(model, path, device='cpu'):
+    """Trace, freeze and save the extractor as a TorchScript graph without hooks or torchvision modules"""
+    torch.jit.save(build_extractor(device, compile_mode='jit', batch_size=1, model=model), path)
+
+
+def export_onnx(model, path, device='cpu'):
+    """Export the extractor as an ONNX graph with a dynamic batch dimension"""
+    try:
+        import onnx  # noqa: F401, used by torch.onnx.export
+    except ImportError:
+        raise ImportError('ONNX export needs onnx and onnxruntime: pip install -r requirements-onnx.txt') from None
+    extractor = FeatureExtractor(model).to(device).eval()
+    example = torch.zeros(1, 3, 224, 224, device=device)
+    dynamic_axes = {name: {0: 'batch'} for name in ['input'] + OUTPUT_NAMES}
+    with torch.no_grad():
+        torch.onnx.export(extractor, example, path, input_names=['input'], output_names=OUTPUT_NAMES,
+                          dynamic_axes=dynamic_axes, opset_version=17)
+
+
+def max_abs_diff(extractor, reference, x):
+    """Largest absolute difference of each output of an extractor to the reference (hooked) model"""
+    feats = extract(extractor, x)
+    return {name: float((feats[name].float() - ref.float()).abs().max())
+            for name, ref in zip(OUTPUT_NAMES, reference(x))}
+
+
+def cold_start(code):
+    """Seconds until the first batch as measured in a fresh process, and the wall time of the whole process"""
+    start = time.perf_counter()
+    out = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                         capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1]), time.perf_counter() - start
+
+
+def main():
+    args = parse_args()
+    from torchvision.models import wide_resnet50_2
+    model = wide_resnet50_2(pretrained=not args.random_weights, progress=True).to(args.device).eval()
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    if args.output.endswith('.onnx'):
+        export_onnx(model, args.output, args.device)
+    else:
+        export_torchscript(model, args.output, args.device)
+    print('exported extractor to: %s' % args.output)
+
+    # the exported graph against the hooked full model on the same weights
+    x = torch.randn(args.batch_size, 3, 224, 224, device=args.device)
+    diffs = max_abs_diff(load_extractor(args.output, args.device), build_hooked_model(args.device, model), x)
+    equivalent = all(diff <= args.atol for diff in diffs.values())
+    print('max abs difference to the hooked model: %s (%s)' % (
+        ', '.join('%s %.2e' % item for item in diffs.items()), 'ok' if equivalent else 'MISMATCH'))
+
+    params = dict(device=args.device, batch_size=args.batch_size)
+    hooked = cold_start(COLD_START_HOOKED.format(pretrained=not args.random_weights, **params))
+    exported = cold_start(COLD_START_EXPORTED.format(path=os.path.abspath(args.output), **params))
+    print('cold start to first batch: hooked model %.2f s (process %.2f s), exported %.2f s (process %.2f s)' % (
+        hooked + exported))
+
+    report = {'output': args.output, 'device': args.device, 'max_abs_diff': diffs, 'equivalent': equivalent,
+              'cold_start_seconds': {'hooked': hooked[0], 'exported': exported[0]},
+              'process_seconds': {'hooked': hooked[1], 'exported': exported[1]}}
+    with open(os.path.splitext(args.output)[0] + '_report.json', 'w') as f:
+        json.dump(report, f, indent=2)
+    if not equivalent:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+import argparse
+import json
+import os
+import platform
+import time
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+
+from options import COMPILE_MODES
+
+
+OUTPUT_NAMES = ['layer1', 'layer2', 'layer3', 'avgpool']
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+
+class FeatureExtractor(nn.Module):
+    """wide_resnet50_2 truncated before fc, returning layer1-3 and avgpool features"""
+
+    def __init__(self, model=None):
+        super().__init__()
+        if model is None:
+            from torchvision.models import wide_resnet50_2
+            model = wide_resnet50_2(pretrained=True, progress=True)
+        self.stem = nn.Sequential(model.conv1, model.bn1, model.relu, model.maxpool)
+        self.layer1 = model.layer1
+        self.layer2 = model.layer2
+        self.layer3 = model.layer3
+        self.layer4 = model.layer4
+        self.avgpool = model.avgpool
+
+    def forward(self, x):
+        x = self.stem(x)
+        feat1 = self.layer1(x)
+        feat2 = self.layer2(feat1)
+        feat3 = self.layer3(feat2)
+        pooled = self.avgpool(self.layer4(feat3))
+        return feat1, feat2, feat3, pooled
+
+
+def build_extractor(device='cpu', compile_mode='none', channels_last=True, batch_size=32, model=None):
+    """FeatureExtractor in eval mode on device, optionally traced and frozen ('jit') or torch.compile'd"""
+    assert compile_mode in COMPILE_MODES, 'compile_mode: {}, should be in {}'.format(compile_mode, COMPILE_MODES)
+    extractor = FeatureExtractor(model).to(device).eval()
+    if channels_last:
+        extractor = extractor.to(memory_format=torch.channels_last)
+    if compile_mode == 'jit':
+        example = torch.zeros(batch_size, 3, 224, 224, device=device)
+        if channels_last:
+            example = example.to(memory_format=torch.channels_last)
+        with torch.inference_mode():
+            extractor = torch.jit.freeze(torch.jit.trace(extractor, example))
+    elif compile_mode == 'compile':
+        extractor = torch.compile(extractor)
+    return extractor
+
+
+class OnnxExtractor:
+    """onnxruntime session of an exported extractor, called like FeatureExtractor"""
+
+    def __init__(self, path, device='cpu'):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError('ONNX extractors need onnxruntime: pip install -r requirements-onnx.txt') from None
+        providers = ['CPUExecutionProvider']
+        if device == 'cuda':
+            providers.insert(0, 'CUDAExecutionProvider')
+        self.session = onnxruntime.InferenceSession(path, providers=providers)
+        self.device = device
+
+    def __call__(self, x):
+        feats = self.session.run(OUTPUT_NAMES, {'input': x.detach().float().contiguous().cpu().numpy()})
+        return tuple(torch.from_numpy(feat).to(self.device) for feat in feats)
+
+
+def build_hooked_model(device='cpu', model=None):
+    """Full wide_resnet50_2 with forward hooks, as originally used by SPADE
+
+    Returns a function mapping a normalized batch to the (layer1, layer2, layer3, avgpool) features.
+    """
+    if model is None:
+        from torchvision.models import wide_resnet50_2
+        model = wide_resnet50_2(pretrained=True, progress=True)
+    model = model.to(device).eval()
+    outputs = []
+    for module in [model.layer1[-1], model.layer2[-1], model.layer3[-1], model.avgpool]:
+        module.register_forward_hook(lambda module, input, output: outputs.append(output))
+
+    def forward(x):
+        outputs.clear()
+        with torch.no_grad():
+            model(x)
+        feats = tuple(outputs)
+        outputs.clear()
+        return feats
+
+    return forward
+
+
+def load_extractor(path, device='cpu'):
+    """Extractor exported by export.py (TorchScript .pt or ONNX .onnx), loaded without torchvision"""
+    if path.endswith('.onnx'):
+        return OnnxExtractor(path, device)
+    return torch.jit.load(path, map_location=device).eval()
+
+
+def load_uint8_image(f, resize=256, cropsize=224):
+    """Resized and center cropped RGB image (path or file object) as a uint8 tensor (3, H, W)"""
+    import numpy as np
+    from PIL import Image
+    from torchvision import transforms as T
+    x = T.CenterCrop(cropsize)(T.Resize(resize, T.InterpolationMode.LANCZOS)(Image.open(f).convert('RGB')))
+    return torch.from_numpy(np.array(x).transpose(2, 0, 1))
+
+
+def normalize(x):
+    """Normalize a uint8 image batch (N, 3, H, W) on its device, as ToTensor + Normalize"""
+    mean = torch.tensor(MEAN, device=x.device).view(1, 3, 1, 1)
+    std = torch.tensor(STD, device=x.device).view(1, 3, 1, 1)
+    return (x.float().div_(255) - mean) / std
+
+
+def extract(extractor, x, channels_last=True):
+    """OrderedDict of layer1-3 and avgpool features for a batch of normalized (or uint8) images"""
+    if x.dtype == torch.uint8:
+        x = normalize(x)
+    if channels_last:
+        x = x.contiguous(memory_format=torch.channels_last)
+    with torch.inference_mode():
+        feats = extractor(x)
+    return OrderedDict((name, feat.contiguous()) for name, feat in zip(OUTPUT_NAMES, feats))
+
+
+def measure_throughput(fn, x, n_iters=10, warmup=2):
+    """Images per second of fn on batch x"""
+    for _ in range(warmup):
+        fn(x)
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        fn(x)
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    return n_iters * x.size(0) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser('SPADE feature extractor benchmark')
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--n_iters", type=int, default=10)
+    parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument("--output", type=str, default='./result/extractor_benchmark.json')
+    args = parser.parse_args()
+
+    x = torch.randn(args.batch_size, 3, 224, 224, device=args.device)
+    throughputs = {}
+
+    # full model with forward hooks, as used before
+    hook_forward = build_hooked_model(args.device)
+    throughputs['hooked'] = measure_throughput(hook_forward, x, args.n_iters)
+    extractor = build_extractor(args.device, 'none', batch_size=args.batch_size)
+    throughputs['eager'] = measure_throughput(lambda x: extract(extractor, x, channels_last=False), x, args.n_iters)
+    for compile_mode in COMPILE_MODES:
+        extractor = build_extractor(args.device, compile_mode, batch_size=args.batch_size)
+        throughputs['channels_last_%s' % compile_mode] = measure_throughput(lambda x: extract(extractor, x), x,
+                                                                           args.n_iters)
+    for name, throughput in throughputs.items():
+        print('%-22s %8.1f images/s' % (name, throughput))
+
+    report = {'device': args.device, 'torch': torch.__version__, 'threads': torch.get_num_threads(),
+              'platform': platform.platform(), 'batch_size': args.batch_size, 'images_per_second': throughputs}
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('extractor benchmark saved to: %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
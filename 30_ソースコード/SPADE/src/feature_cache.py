@@ -0,0 +1,413 @@
+import glob
+import hashlib
+import io
+import json
+import os
+import shutil
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from options import DTYPES
+
+
+CACHE_VERSION = 1
+META_FILENAME = 'meta.json'
+# indexes saved next to a bank, built from its content
+INDEX_PATTERNS = ['ann_*.pt', 'image_index_*.pt']
+# numpy has no bfloat16, its bits are stored as int16
+STORAGE_DTYPES = {'float32': np.float32, 'float16': np.float16, 'bfloat16': np.int16, 'int8': np.int8}
+
+
+class EncodedFeatures:
+    """Layer stored as bfloat16 bits or as int8 with a symmetric scale per channel (axis 1)
+
+    Indexing rows returns another EncodedFeatures, as_tensor() and gather() decode
+    to a float tensor.
+    """
+
+    def __init__(self, data, dtype, scale=None):
+        self.data = data
+        self.dtype = dtype
+        self.scale = scale
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + (0 if self.scale is None else self.scale.nbytes)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, rows):
+        return EncodedFeatures(self.data[rows], self.dtype, self.scale)
+
+    def decode(self, device='cpu', dtype=torch.float32):
+        data = torch.from_numpy(np.ascontiguousarray(self.data)).to(device)
+        if self.dtype == 'bfloat16':
+            return data.view(torch.bfloat16).to(dtype)
+        scale = torch.from_numpy(self.scale).to(device).view(1, -1, *[1] * (data.dim() - 2))
+        return (data.float() * scale).to(dtype)
+
+
+def int8_scale(feat):
+    """Smallest symmetric per-channel (axis 1) int8 scale that represents feat without clipping, 0 for zero channels"""
+    axes = tuple(axis for axis in range(feat.ndim) if axis != 1)
+    return (np.abs(feat).max(axis=axes) / 127).astype(np.float32)
+
+
+def channel_shape(ndim):
+    """Shape that broadcasts a per-channel (axis 1) vector against an array of ndim dimensions"""
+    return [1, -1] + [1] * (ndim - 2)
+
+
+def encode(feat, dtype, scale=None):
+    """(data, scale) of a float32 array in the storage format of dtype, scale is None except for int8
+
+    For int8 an existing per-channel scale can be given, values beyond it are clipped.
+    """
+    if dtype == 'bfloat16':
+        return torch.from_numpy(np.ascontiguousarray(feat, dtype=np.float32)).to(torch.bfloat16) \
+            .view(torch.int16).numpy(), None
+    if dtype == 'int8':
+        if scale is None:
+            scale = int8_scale(feat)
+            scale[scale == 0] = 1
+        return np.clip(np.rint(feat / scale.reshape(channel_shape(feat.ndim))), -127, 127).astype(np.int8), scale
+    return feat.astype(dtype, copy=False), None
+
+
+def bank_nbytes(outputs):
+    """Bytes held by all layers of a feature bank"""
+    return sum(feat.element_size() * feat.nelement() if isinstance(feat, torch.Tensor) else feat.nbytes
+               for feat in outputs.values())
+
+
+def save_features(cache_dir, outputs, dtype='float32', **meta):
+    """Save each layer of outputs as a separate .npy file plus a meta.json header
+
+    The header is written last, so an interrupted save is never mistaken for a complete cache.
+    """
+    assert dtype in DTYPES, 'dtype: {}, should be in {}'.format(dtype, DTYPES)
+    os.makedirs(cache_dir, exist_ok=True)
+    meta_path = os.path.join(cache_dir, META_FILENAME)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    for pattern in INDEX_PATTERNS:
+        for index_path in glob.glob(os.path.join(cache_dir, pattern)):
+            os.remove(index_path)
+
+    layers = OrderedDict()
+    for layer_name, feat in outputs.items():
+        if isinstance(feat, EncodedFeatures) and feat.dtype == dtype:
+            data, scale = feat.data, feat.scale
+        else:
+            feat = as_tensor(feat).numpy() if isinstance(feat, (torch.Tensor, EncodedFeatures)) else np.asarray(feat)
+            data, scale = encode(feat, dtype)
+        np.save(os.path.join(cache_dir, '%s.npy' % layer_name), data)
+        if scale is not None:
+            np.save(os.path.join(cache_dir, '%s_scale.npy' % layer_name), scale)
+        layers[layer_name] = list(data.shape)
+
+    header = dict(meta, version=CACHE_VERSION, dtype=dtype, layers=layers)
+    with open(meta_path, 'w') as f:
+        json.dump(header, f, indent=2)
+
+
+def load_meta(cache_dir):
+    """Header of the cache in cache_dir, or None if there is no complete cache"""
+    meta_path = os.path.join(cache_dir, META_FILENAME)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        return json.load(f)
+
+
+def load_features(cache_dir, dtype='float32', **meta):
+    """Memory-mapped layers of the cache in cache_dir
+
+    Returns None if the cache is missing, was written by another format version,
+    or does not match the requested dtype and meta entries.
+    """
+    header = load_meta(cache_dir)
+    if header is None:
+        return None
+    expected = dict(meta, version=CACHE_VERSION, dtype=dtype)
+    stale = [key for key, value in expected.items() if header.get(key) != value]
+    if stale:
+        print('ignore stale feature cache %s (%s)' % (cache_dir, ', '.join(stale)))
+        return None
+
+    outputs = OrderedDict()
+    for layer_name, shape in header['layers'].items():
+        feat = np.load(os.path.join(cache_dir, '%s.npy' % layer_name), mmap_mode='r')
+        if list(feat.shape) != shape or feat.dtype != STORAGE_DTYPES[dtype]:
+            print('ignore corrupted feature cache %s (%s)' % (cache_dir, layer_name))
+            return None
+        if dtype == 'bfloat16':
+            feat = EncodedFeatures(feat, dtype)
+        elif dtype == 'int8':
+            feat = EncodedFeatures(feat, dtype, np.load(os.path.join(cache_dir, '%s_scale.npy' % layer_name)))
+        outputs[layer_name] = feat
+    return outputs
+
+
+def bank_digest(outputs):
+    """Short digest of the content of a bank, to tie indexes built from it to it
+
+    Hashes the shape and storage dtype of every layer and the stored avgpool rows,
+    which identify the train images, without reading the large layer maps.
+    """
+    digest = hashlib.sha1()
+    for layer_name, feat in outputs.items():
+        if isinstance(feat, EncodedFeatures):
+            data, scale = feat.data, feat.scale
+        else:
+            data, scale = (feat.detach().cpu().numpy() if isinstance(feat, torch.Tensor) else feat), None
+        digest.update(('%s %s %s;' % (layer_name, tuple(data.shape), data.dtype)).encode())
+        if layer_name == 'avgpool':
+            digest.update(np.ascontiguousarray(data).tobytes())
+            if scale is not None:
+                digest.update(np.ascontiguousarray(scale).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def keys_digest(keys):
+    """Short digest of the ordered content keys of a bank, to tie derived caches to it"""
+    return hashlib.sha1(json.dumps(keys).encode()).hexdigest()[:16]
+
+
+def update_features(cache_dir, keys, extract, dtype='float32', files=None, chunk_size=64, **meta):
+    """Bring the cache in cache_dir up to date with the images identified by content keys
+
+    Rows of images whose key is already cached are kept, extract(indexes) is called
+    once for the indexes of all other images and returns their outputs, or an
+    iterable of batches of outputs in the order of indexes. Batches are spooled to
+    float32 memory-mapped files as they arrive and encoded chunk by chunk, so the
+    new rows are never held in memory all at once. Rows of removed or changed images
+    are dropped. When the new images are only appended after the cached ones, their
+    rows are appended to the .npy files in place (see append_features), so the
+    update writes only the new rows. Otherwise the new cache is written next to the
+    old one, copying the kept rows chunk by chunk, and swapped in when complete. If
+    new images exceed the int8 scale of a channel, its scale is raised and the kept
+    rows are quantized again, which also rewrites the cache.
+    files is stored in the header as is, e.g. to skip hashing unchanged files.
+    Returns the memory-mapped outputs and the number of extracted images.
+    Raises ValueError for an empty list of keys, as a bank needs at least one image.
+    """
+    if not keys:
+        raise ValueError('no images to build the feature cache %s from' % cache_dir)
+    header = load_meta(cache_dir)
+    old_outputs = None
+    if header is not None and 'keys' in header:
+        old_outputs = load_features(cache_dir, dtype=dtype, **meta)
+    old_rows = {}
+    if old_outputs is not None:
+        old_rows = {key: row for row, key in enumerate(header['keys'])}
+        if header['keys'] == keys:
+            return old_outputs, 0
+
+    kept = [(row, old_rows[key]) for row, key in enumerate(keys) if key in old_rows]
+    missing = [row for row, key in enumerate(keys) if key not in old_rows]
+    spool_dir = cache_dir.rstrip(os.sep) + '.new'
+    new_outputs = spool_features(spool_dir, extract(missing), len(missing)) if missing else None
+    print('update feature cache %s: %d kept, %d extracted, %d dropped' % (
+        cache_dir, len(kept), len(missing), len(old_rows) - len(kept)))
+
+    # new rows of each layer: (float32 memory map, storage scale, rescale of the kept int8 rows or None)
+    spooled = OrderedDict()
+    for layer_name in (old_outputs or new_outputs).keys():
+        old = old_outputs[layer_name] if old_outputs is not None else None
+        scale, rescale, new = getattr(old, 'scale', None), None, None
+        if new_outputs is not None:
+            new = new_outputs[layer_name]
+            if dtype == 'int8':
+                new_scale = np.max([int8_scale(new[start:start + chunk_size])
+                                    for start in range(0, len(new), chunk_size)], axis=0)
+                if scale is None:
+                    scale = new_scale
+                    scale[scale == 0] = 1
+                elif (new_scale > scale).any():
+                    # a larger scale for the channels that the new images exceed, instead of clipping them
+                    new_scale = np.maximum(scale, new_scale)
+                    print('requantize %s of %s: %d channels exceed the int8 scale' % (
+                        layer_name, cache_dir, (new_scale > scale).sum()))
+                    rescale, scale = (scale / new_scale).reshape(channel_shape(new.ndim)), new_scale
+        spooled[layer_name] = new, scale, rescale
+
+    def encoded_chunks(new, scale):
+        """The new rows of a layer in the storage format, chunk_size rows at a time"""
+        for start in range(0, len(new), chunk_size):
+            yield encode(np.asarray(new[start:start + chunk_size]), dtype, scale)[0]
+
+    n_old = len(header['keys']) if old_outputs is not None else 0
+    header = dict(meta, version=CACHE_VERSION, dtype=dtype, keys=keys, files=files)
+    if old_outputs is not None and kept == [(row, row) for row in range(n_old)] and \
+            all(rescale is None for _, _, rescale in spooled.values()):
+        # only appended images: the memory maps of the old files are closed before they grow
+        old_outputs = None
+        appended = append_features(cache_dir, OrderedDict(
+            (layer_name, (len(new), tuple(new.shape[1:]), encoded_chunks(new, scale)))
+            for layer_name, (new, scale, _) in spooled.items()), STORAGE_DTYPES[dtype], header)
+        if appended:
+            new_outputs = None
+            shutil.rmtree(spool_dir, ignore_errors=True)
+            return load_features(cache_dir, dtype=dtype, **meta), len(missing)
+        old_outputs = load_features(cache_dir, dtype=dtype, **meta)
+
+    tmp_dir = cache_dir.rstrip(os.sep) + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    layers = OrderedDict()
+    for layer_name, (new, scale, rescale) in spooled.items():
+        old = old_outputs[layer_name] if old_outputs is not None else None
+        # the stored rows: np.memmap.data would be its raw buffer
+        old = old.data if isinstance(old, EncodedFeatures) else old
+        shape = (len(keys),) + tuple((old if old is not None else new).shape[1:])
+        out = np.lib.format.open_memmap(os.path.join(tmp_dir, '%s.npy' % layer_name), mode='w+',
+                                        dtype=STORAGE_DTYPES[dtype], shape=shape)
+        for start in range(0, len(kept), chunk_size):
+            rows, old_rows_chunk = zip(*kept[start:start + chunk_size])
+            chunk = old[list(old_rows_chunk)]
+            if rescale is not None:
+                chunk = np.rint(chunk * rescale).astype(np.int8)
+            out[list(rows)] = chunk
+        if new is not None:
+            for start, chunk in zip(range(0, len(missing), chunk_size), encoded_chunks(new, scale)):
+                out[missing[start:start + chunk_size]] = chunk
+        out.flush()
+        del out
+        if scale is not None:
+            np.save(os.path.join(tmp_dir, '%s_scale.npy' % layer_name), scale)
+        layers[layer_name] = list(shape)
+
+    with open(os.path.join(tmp_dir, META_FILENAME), 'w') as f:
+        json.dump(dict(header, layers=layers), f, indent=2)
+    # swap the complete cache in, the previous one (and indexes built on it) is discarded
+    old_outputs = new_outputs = spooled = None
+    shutil.rmtree(spool_dir, ignore_errors=True)
+    old_dir = cache_dir.rstrip(os.sep) + '.old'
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(cache_dir):
+        os.replace(cache_dir, old_dir)
+    os.replace(tmp_dir, cache_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return load_features(cache_dir, dtype=dtype, **meta), len(missing)
+
+
+def spool_features(spool_dir, batches, n):
+    """Write the batches of outputs of n images to float32 .npy files in spool_dir, as memory maps
+
+    batches is one OrderedDict of layers or an iterable of them, each layer a tensor
+    or an array with one row per image. Only one batch is in memory at a time.
+    """
+    if isinstance(batches, dict):
+        batches = [batches]
+    shutil.rmtree(spool_dir, ignore_errors=True)
+    os.makedirs(spool_dir)
+    outputs, start = OrderedDict(), 0
+    for batch in batches:
+        size = None
+        for layer_name, feat in batch.items():
+            feat = as_tensor(feat).numpy() if isinstance(feat, (torch.Tensor, EncodedFeatures)) else np.asarray(feat)
+            if layer_name not in outputs:
+                outputs[layer_name] = np.lib.format.open_memmap(
+                    os.path.join(spool_dir, '%s.npy' % layer_name), mode='w+', dtype=np.float32,
+                    shape=(n,) + feat.shape[1:])
+            outputs[layer_name][start:start + len(feat)] = feat
+            size = len(feat)
+        start += size
+    assert start == n, 'extracted {} of {} images'.format(start, n)
+    return outputs
+
+
+def append_features(cache_dir, chunks, storage_dtype, header):
+    """Append rows {layer_name: (n_rows, row shape, iterable of row chunks)} to the layers of the cache in place
+
+    The rows are written after the end of every .npy file first, then the .npy
+    headers are updated and the cache header is replaced last, so an interrupted
+    append leaves either the previous cache or one that load_features() rejects.
+    Returns False, without changing anything, if a .npy header has no room for the
+    new number of rows.
+    """
+    plans = OrderedDict()
+    for layer_name, (n_rows, row_shape, _) in chunks.items():
+        plan = append_plan(os.path.join(cache_dir, '%s.npy' % layer_name), n_rows, row_shape, storage_dtype)
+        if plan is None:
+            return False
+        plans[layer_name] = plan
+
+    # indexes saved next to the bank are built from its content
+    for pattern in INDEX_PATTERNS:
+        for index_path in glob.glob(os.path.join(cache_dir, pattern)):
+            os.remove(index_path)
+    for layer_name, (offset, _, _) in plans.items():
+        with open(os.path.join(cache_dir, '%s.npy' % layer_name), 'r+b') as f:
+            # drop the rows of an interrupted append, if any
+            f.truncate(offset)
+            f.seek(offset)
+            for chunk in chunks[layer_name][2]:
+                f.write(np.ascontiguousarray(chunk, dtype=storage_dtype).tobytes())
+    for layer_name, (_, npy_header, _) in plans.items():
+        with open(os.path.join(cache_dir, '%s.npy' % layer_name), 'r+b') as f:
+            f.write(npy_header)
+    meta_path = os.path.join(cache_dir, META_FILENAME)
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump(dict(header, layers=OrderedDict((name, shape) for name, (_, _, shape) in plans.items())), f,
+                  indent=2)
+    os.replace(meta_path + '.tmp', meta_path)
+    return True
+
+
+def append_plan(path, n_rows, row_shape, storage_dtype):
+    """(end of the data, new .npy header, new shape) to append n_rows rows to the .npy file at path, or None
+
+    None if the file is not a C-ordered array of storage_dtype with rows of row_shape,
+    or if the new header does not fit in the space of the current one. numpy pads
+    .npy headers so that the first axis can grow, so it fits except for old files.
+    """
+    with open(path, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version not in [(1, 0), (2, 0)]:
+            return None
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else \
+            np.lib.format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(f)
+        data_offset = f.tell()
+    if fortran_order or dtype != np.dtype(storage_dtype) or tuple(shape[1:]) != tuple(row_shape):
+        return None
+    new_shape = (shape[0] + n_rows,) + tuple(shape[1:])
+    npy_header = io.BytesIO()
+    write_header = np.lib.format.write_array_header_1_0 if version == (1, 0) else \
+        np.lib.format.write_array_header_2_0
+    write_header(npy_header, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False,
+                              'shape': new_shape})
+    if len(npy_header.getvalue()) != data_offset:
+        return None
+    return data_offset + int(np.prod(shape)) * dtype.itemsize, npy_header.getvalue(), list(new_shape)
+
+
+def as_tensor(feat, device='cpu', dtype=torch.float32):
+    """Whole layer (torch tensor, memory-mapped array or EncodedFeatures) as a tensor of dtype on device"""
+    if isinstance(feat, EncodedFeatures):
+        return feat.decode(device, dtype)
+    if not isinstance(feat, torch.Tensor):
+        feat = torch.from_numpy(np.ascontiguousarray(feat))
+    return feat.to(device=device, dtype=dtype)
+
+
+def gather(feat, indexes, device='cpu', dtype=torch.float32):
+    """Rows of a layer (torch tensor, memory-mapped array or EncodedFeatures) as a tensor of dtype on device
+
+    For memory-mapped layers only the requested rows are read, in ascending order,
+    and encoded rows are decoded on device.
+    """
+    if isinstance(feat, torch.Tensor):
+        return feat[indexes.to(feat.device)].to(device=device, dtype=dtype)
+    unique, inverse = np.unique(indexes.cpu().numpy(), return_inverse=True)
+    rows = as_tensor(feat[unique], device, dtype)
+    return rows[torch.from_numpy(inverse.reshape(tuple(indexes.shape))).to(device)]
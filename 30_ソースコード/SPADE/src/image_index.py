@@ -0,0 +1,260 @@
+import argparse
+import heapq
+import math
+import time
+
+import numpy as np
+import torch
+
+from ann import IVFIndex
+from distance import calc_dist_matrix, knn
+from feature_cache import as_tensor, load_features, load_meta
+from options import INDEX_TYPES
+
+
+class BruteForceIndex:
+    """Exact search over all stored vectors with the tiled distance.knn, products computed in dtype"""
+
+    VERSION = 1
+
+    def __init__(self, tile_size=1024, dtype='float32'):
+        self.tile_size = tile_size
+        self.dtype = dtype
+        self.data = None
+        self.digest = None
+
+    def __len__(self):
+        return 0 if self.data is None else self.data.size(0)
+
+    def add(self, x):
+        x = x.to(getattr(torch, self.dtype))
+        self.data = x if self.data is None else torch.cat([self.data, x.to(self.data.device)])
+        return self
+
+    def search(self, queries, k):
+        """k nearest stored vectors for each query, as (distances, ids) sorted ascending"""
+        queries = queries.to(self.data.device, self.data.dtype)
+        return knn(queries, self.data, k, row_tile=self.tile_size, col_tile=self.tile_size)
+
+    def state_dict(self):
+        return {'version': self.VERSION, 'tile_size': self.tile_size, 'dtype': self.dtype, 'data': self.data,
+                'digest': self.digest}
+
+    @classmethod
+    def from_state_dict(cls, state, path=None):
+        if state.get('version') != cls.VERSION:
+            raise ValueError('unsupported index version in %s: %s' % (path, state.get('version')))
+        index = cls(tile_size=state['tile_size'], dtype=state['dtype'])
+        index.data = state['data']
+        index.digest = state.get('digest')
+        return index
+
+
+class BallTreeIndex:
+    """Exact nearest neighbour search with a ball tree, on the CPU
+
+    Each node stores the center and radius of a ball holding its vectors, split in
+    two halves along the direction between two far apart vectors, down to leaf_size
+    vectors per leaf. A query visits nodes closest-bound first and skips every ball
+    farther away than its current k-th neighbour, so well clustered data only
+    scans a few leaves; for unstructured high dimensional data it degrades to a scan.
+    """
+
+    VERSION = 1
+
+    def __init__(self, leaf_size=32):
+        self.leaf_size = leaf_size
+        self.data = None
+        self.ids = None
+        self.centers = None
+        self.radii = None
+        self.children = None
+        self.bounds = None
+        self.digest = None
+
+    def __len__(self):
+        return 0 if self.data is None else len(self.data)
+
+    def add(self, x):
+        """Store x and (re)build the tree over all stored vectors"""
+        x = x.detach().cpu().float().numpy()
+        data = x if self.data is None else np.concatenate([self.data[np.argsort(self.ids)], x])
+        order = np.arange(len(data))
+        centers, radii, children, bounds = [], [], [], []
+        stack = [(0, len(data), -1, 0)]
+        while stack:
+            start, end, parent, side = stack.pop()
+            node = len(centers)
+            if parent >= 0:
+                children[parent][side] = node
+            points = data[order[start:end]]
+            center = points.mean(0)
+            centers.append(center)
+            radii.append(np.sqrt(((points - center) ** 2).sum(1).max()))
+            children.append([-1, -1])
+            bounds.append([start, end])
+            if end - start <= self.leaf_size:
+                continue
+            # split at the median of the projection on the direction between two far apart points
+            a = points[np.argmax(((points - center) ** 2).sum(1))]
+            b = points[np.argmax(((points - a) ** 2).sum(1))]
+            order[start:end] = order[start:end][np.argsort(points @ (b - a), kind='stable')]
+            mid = (start + end) // 2
+            stack.append((mid, end, node, 1))
+            stack.append((start, mid, node, 0))
+        self.data = data[order]
+        self.ids = order
+        self.centers = np.stack(centers)
+        self.radii = np.array(radii, dtype=np.float32)
+        self.children = np.array(children)
+        self.bounds = np.array(bounds)
+        return self
+
+    def search(self, queries, k):
+        """k nearest stored vectors for each query, as (distances, ids) sorted ascending"""
+        k = min(k, len(self))
+        device = queries.device
+        queries = queries.detach().cpu().float().numpy()
+        values = np.empty((len(queries), k), dtype=np.float32)
+        indexes = np.empty((len(queries), k), dtype=np.int64)
+        for row, query in enumerate(queries):
+            values[row], indexes[row] = self._search_one(query, k)
+        return torch.from_numpy(values).to(device), torch.from_numpy(indexes).to(device)
+
+    def _search_one(self, query, k):
+        best_dist = np.full(k, np.inf, dtype=np.float32)
+        best_ids = np.full(k, -1, dtype=np.int64)
+        root_bound = max(0., np.sqrt(((self.centers[0] - query) ** 2).sum()) - self.radii[0])
+        heap = [(root_bound, 0)]
+        while heap:
+            bound, node = heapq.heappop(heap)
+            if bound > best_dist[-1]:
+                break
+            left, right = self.children[node]
+            if left < 0:
+                start, end = self.bounds[node]
+                dist = np.sqrt(((self.data[start:end] - query) ** 2).sum(1))
+                merged_dist = np.concatenate([best_dist, dist])
+                merged_ids = np.concatenate([best_ids, self.ids[start:end]])
+                order = np.argsort(merged_dist, kind='stable')[:k]
+                best_dist, best_ids = merged_dist[order], merged_ids[order]
+                continue
+            child = np.array([left, right])
+            child_bounds = np.sqrt(((self.centers[child] - query) ** 2).sum(1)) - self.radii[child]
+            for child_node, child_bound in zip(child, np.maximum(child_bounds, 0.)):
+                if child_bound <= best_dist[-1]:
+                    heapq.heappush(heap, (float(child_bound), int(child_node)))
+        return best_dist, best_ids
+
+    def state_dict(self):
+        return {'version': self.VERSION, 'leaf_size': self.leaf_size, 'digest': self.digest,
+                **{name: torch.from_numpy(getattr(self, name))
+                   for name in ['data', 'ids', 'centers', 'radii', 'children', 'bounds']}}
+
+    @classmethod
+    def from_state_dict(cls, state, path=None):
+        if state.get('version') != cls.VERSION:
+            raise ValueError('unsupported index version in %s: %s' % (path, state.get('version')))
+        index = cls(leaf_size=state['leaf_size'])
+        for name in ['data', 'ids', 'centers', 'radii', 'children', 'bounds']:
+            setattr(index, name, state[name].cpu().numpy())
+        index.digest = state.get('digest')
+        return index
+
+
+INDEX_CLASSES = {'brute': BruteForceIndex, 'balltree': BallTreeIndex, 'ivf': IVFIndex}
+
+
+def ivf_n_lists(n, n_lists=None):
+    """Cells of an IVF index over n vectors: n_lists, sqrt(n) by default, and at most n"""
+    return min(n_lists or max(1, int(math.sqrt(n))), n)
+
+
+def build_image_index(index_type, x, tile_size=1024, dtype='float32', leaf_size=32, n_lists=None, n_probe=8):
+    """Index of type index_type over the rows of x (N, d), searched with index.search(queries, k)
+
+    For 'ivf', n_lists defaults to sqrt(N) cells.
+    """
+    assert index_type in INDEX_TYPES, 'index_type: {}, should be in {}'.format(index_type, INDEX_TYPES)
+    if index_type == 'brute':
+        return BruteForceIndex(tile_size=tile_size, dtype=dtype).add(x)
+    if index_type == 'balltree':
+        return BallTreeIndex(leaf_size=leaf_size).add(x)
+    return IVFIndex(n_lists=ivf_n_lists(x.size(0), n_lists), n_probe=n_probe).train(x).add(x)
+
+
+def save_image_index(index, path):
+    index_type = next(name for name, cls in INDEX_CLASSES.items() if isinstance(index, cls))
+    torch.save(dict(index.state_dict(), index_type=index_type), path)
+
+
+def load_image_index(path, map_location='cpu'):
+    state = torch.load(path, map_location=map_location)
+    return INDEX_CLASSES[state.pop('index_type')].from_state_dict(state, path)
+
+
+def dist_matrix_knn(queries, x, k):
+    """k nearest rows by the full distance matrix and torch.topk, the reference for the benchmark"""
+    return torch.topk(calc_dist_matrix(queries, x), k=k, dim=1, largest=False)
+
+
+def synthetic_embeddings(n, dim, n_clusters, generator):
+    """Clustered non-negative vectors, shaped like pooled CNN features"""
+    centers = torch.rand(n_clusters, dim, generator=generator) * 2
+    assign = torch.randint(n_clusters, (n,), generator=generator)
+    return torch.relu(centers[assign] + 0.3 * torch.randn(n, dim, generator=generator))
+
+
+def main():
+    parser = argparse.ArgumentParser('SPADE image-level index benchmark')
+    parser.add_argument("--feature_dir", type=str, default=None, help='train feature cache to take avgpool '
+                                                                      'features from (default: synthetic)')
+    parser.add_argument("--n_train", type=int, default=20000)
+    parser.add_argument("--n_test", type=int, default=200)
+    parser.add_argument("--dim", type=int, default=2048)
+    parser.add_argument("--n_clusters", type=int, default=64)
+    parser.add_argument("--top_k", type=int, default=5)
+    parser.add_argument("--leaf_size", type=int, default=32)
+    parser.add_argument("--n_lists", type=int, default=None)
+    parser.add_argument("--n_probe", type=int, default=8)
+    parser.add_argument("--index", type=str, nargs='+', default=INDEX_TYPES, choices=INDEX_TYPES)
+    parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    generator = torch.Generator().manual_seed(0)
+    if args.feature_dir is not None:
+        header = load_meta(args.feature_dir)
+        feat = torch.flatten(as_tensor(load_features(args.feature_dir, dtype=header['dtype'],
+                                                     class_name=header.get('class_name'))['avgpool']), 1)
+        perm = torch.randperm(feat.size(0), generator=generator)
+        n_test = min(args.n_test, feat.size(0) // 2)
+        queries, x = feat[perm[:n_test]], feat[perm[n_test:]]
+    else:
+        feat = synthetic_embeddings(args.n_train + args.n_test, args.dim, args.n_clusters, generator)
+        queries, x = feat[:args.n_test], feat[args.n_test:]
+    queries, x = queries.to(args.device), x.to(args.device)
+    print('%d train, %d test embeddings of dim %d' % (x.size(0), queries.size(0), x.size(1)))
+
+    def timed(fn):
+        if args.device == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        out = fn()
+        if args.device == 'cuda':
+            torch.cuda.synchronize()
+        return out, time.perf_counter() - start
+
+    (_, exact_indexes), search_time = timed(lambda: dist_matrix_knn(queries, x, args.top_k))
+    print('%-12s build %8.3f s, search %8.3f s, recall@%d %.3f' % ('dist_matrix', 0., search_time, args.top_k, 1.))
+    for index_type in args.index:
+        index, build_time = timed(lambda: build_image_index(index_type, x, leaf_size=args.leaf_size,
+                                                            n_lists=args.n_lists, n_probe=args.n_probe))
+        (_, indexes), search_time = timed(lambda: index.search(queries, args.top_k))
+        recall = np.mean([len(set(a) & set(b)) / args.top_k
+                          for a, b in zip(indexes.tolist(), exact_indexes.tolist())])
+        print('%-12s build %8.3f s, search %8.3f s, recall@%d %.3f' % (index_type, build_time, search_time,
+                                                                       args.top_k, recall))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import numpy as np
+import torch
+
+from ann import patch_bank
+from distance import batched_min_dist, windowed_min_dist
+from feature_cache import gather
+from postprocess import postprocess
+
+
+LAYER_NAMES = ['layer1', 'layer2', 'layer3']
+
+
+def loc_batch_size(train_outputs, top_k, memory_budget_mb, layer_names=LAYER_NAMES, element_size=4, copies=1):
+    """Number of test images whose top-K galleries fit in half of the memory budget
+
+    copies is the number of copies of a gallery alive at the same time.
+    """
+    budget = memory_budget_mb * 1024 ** 2 // 2
+    per_image = max(int(np.prod(train_outputs[layer_name].shape[1:])) * element_size * top_k * copies
+                    for layer_name in layer_names)
+    return max(1, budget // per_image)
+
+
+def calc_score_maps(test_outputs, train_outputs, topk_indexes, img_size=224, sigma=4,
+                    memory_budget_mb=512, layer_names=LAYER_NAMES, patch_indexes=None, n_probe=None,
+                    desc=None, dtype=torch.float32, window_radius=None):
+    """Pixel-level anomaly score maps for all test images
+
+    Test images are scored in batches against the features at all pixel locations
+    of their K nearest train images, which are gathered from train_outputs (tensors
+    or memory-mapped arrays) batch by batch. Batch size and gallery chunks are derived from
+    memory_budget_mb: one half holds the gathered galleries, the other the distances.
+    If patch_indexes holds an ann.IVFIndex per layer, each test patch is searched
+    against all train patches of that layer instead of the top-K gallery.
+    Galleries are held and compared in dtype, distances are accumulated in float32.
+    If window_radius is given, each test patch is only compared with the patches of
+    the K nearest train images within window_radius cells of its own location
+    (in the cells of each layer), which suits well-aligned object classes.
+    """
+    score_map_list = []
+    for layer_score_maps in iter_layer_score_maps(test_outputs, train_outputs, topk_indexes, memory_budget_mb,
+                                                  layer_names, patch_indexes, n_probe, desc, dtype,
+                                                  window_radius):
+        # upsample, average distance between the features and apply gaussian smoothing on the device
+        score_maps = postprocess(layer_score_maps, img_size=img_size, sigma=sigma)
+        score_map_list.extend(score_maps.cpu().detach().numpy())
+
+    return score_map_list
+
+
+def iter_layer_score_maps(test_outputs, train_outputs, topk_indexes, memory_budget_mb=512,
+                          layer_names=LAYER_NAMES, patch_indexes=None, n_probe=None, desc=None,
+                          dtype=torch.float32, window_radius=None):
+    """Per-layer nearest patch distances (B, 1, h, w) of each batch of test images, see calc_score_maps"""
+    n_test, top_k = topk_indexes.shape
+    # the windowed distance holds float32 differences as large as the gallery
+    element_size = 4 if window_radius is not None else torch.empty((), dtype=dtype).element_size()
+    # the (b, K * h * w, c) gallery is a copy of the gathered maps, both exist while it is made
+    copies = 1 if window_radius is not None else 2
+    batch_size = loc_batch_size(train_outputs, top_k, memory_budget_mb, layer_names, element_size, copies)
+    max_elements = max(1, memory_budget_mb * 1024 ** 2 // 2 // 4)
+
+    starts = range(0, n_test, batch_size)
+    if desc is not None:
+        from tqdm import tqdm
+        starts = tqdm(starts, desc)
+    for start in starts:
+        topk_batch = topk_indexes[start:start + batch_size]
+        b = topk_batch.size(0)
+
+        layer_score_maps = []
+        for layer_name in layer_names:
+            if patch_indexes is not None:
+                # nearest feature among all train patches (k=1)
+                test_feat = test_outputs[layer_name][start:start + b]
+                h, w = test_feat.shape[2:]
+                score_map, _ = patch_indexes[layer_name].search(patch_bank(test_feat), k=1, n_probe=n_probe)
+                layer_score_maps.append(score_map.view(b, 1, h, w))
+                continue
+
+            # construct a gallery of features at all pixel locations of the K nearest neighbors
+            c, h, w = train_outputs[layer_name].shape[1:]
+            topk_feat_map = gather(train_outputs[layer_name], topk_batch.flatten(), device=topk_batch.device,
+                                   dtype=dtype)
+            if window_radius is not None:
+                test_feat = test_outputs[layer_name][start:start + b].to(topk_feat_map)
+                score_map = windowed_min_dist(test_feat, topk_feat_map.view(b, top_k, c, h, w), window_radius)
+                layer_score_maps.append(score_map.view(b, 1, h, w))
+                continue
+
+            feat_gallery = topk_feat_map.view(b, top_k, c, h * w).permute(0, 1, 3, 2).reshape(b, top_k * h * w, c)
+            del topk_feat_map
+            test_feat = test_outputs[layer_name][start:start + b].flatten(2).transpose(1, 2)
+
+            # k nearest features from the gallery (k=1)
+            score_map = batched_min_dist(test_feat.to(feat_gallery), feat_gallery, max_elements)
+            layer_score_maps.append(score_map.view(b, 1, h, w))
+
+        yield layer_score_maps
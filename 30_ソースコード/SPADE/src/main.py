@@ -1,53 +1,303 @@
+import time
+START_TIME = time.perf_counter()
+
 import argparse
-import numpy as np
+import json
 import os
-import pickle
-from tqdm import tqdm
-from collections import OrderedDict
-from sklearn.metrics import roc_auc_score
-from sklearn.metrics import roc_curve
-from sklearn.metrics import precision_recall_curve
-from scipy.ndimage import gaussian_filter
-import matplotlib.pyplot as plt
+import sys
 
-import torch
-import torch.nn.functional as F
-from torch.utils.data import DataLoader
-from torchvision.models import wide_resnet50_2
+from options import CLASS_NAMES, COMPILE_MODES, DIST_DTYPES, DTYPES, INDEX_TYPES
 
-import datasets.mvtec as mvtec
+# everything else (torch, numpy, tqdm, the datasets, matplotlib, ...) is imported by the commands that use it
+IMPORT_SECONDS = time.perf_counter() - START_TIME
 
+COMMANDS = ['extract', 'fit', 'evaluate', 'predict', 'plot']
 
-def parse_args():
-    parser = argparse.ArgumentParser('SPADE')
+
+def add_bank_args(parser):
+    """Arguments of the feature extractor, the train feature bank and its search"""
+    parser.add_argument("--class_names", type=str, nargs='+', default=CLASS_NAMES, choices=CLASS_NAMES)
     parser.add_argument("--top_k", type=int, default=5)
     parser.add_argument("--save_path", type=str, default="./result")
-    return parser.parse_args()
+    parser.add_argument("--memory_budget_mb", type=int, default=512)
+    parser.add_argument("--tile_size", type=int, default=1024)
+    parser.add_argument("--data_cache", action='store_true', help='cache preprocessed images as uint8 arrays')
+    parser.add_argument("--verify_dataset", action='store_true', help='check the sha256 of every dataset file '
+                        'against the completion marker of its class, not only its size')
+    parser.add_argument("--archive_sha256", type=str, default=None, help='expected sha256 of the dataset archive, '
+                        'checked before extracting from it')
+    parser.add_argument("--uint8", action='store_true', help='load uint8 batches and normalize them on the device')
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--prefetch_factor", type=int, default=2)
+    parser.add_argument("--compile", type=str, default='none', choices=COMPILE_MODES)
+    parser.add_argument("--extractor_path", type=str, default=None, help='extractor exported by export.py, '
+                                                                         'used instead of --compile')
+    parser.add_argument("--cache_dtype", type=str, default='float32', choices=DTYPES,
+                        help='storage of the train feature bank (int8: quantized per channel)')
+    parser.add_argument("--dist_dtype", type=str, default='float32', choices=DIST_DTYPES,
+                        help='dtype of the products in the distances, rounded in that dtype '
+                        'before the float32 norms are added')
+    parser.add_argument("--image_index", type=str, default='brute', choices=INDEX_TYPES,
+                        help='search structure of the image-level kNN over avgpool features')
+    parser.add_argument("--image_n_lists", type=int, default=None, help='cells of --image_index ivf '
+                                                                        '(default: sqrt of the train size)')
+    parser.add_argument("--ann", action='store_true', help='search all train patches with an IVF index')
+    parser.add_argument("--n_lists", type=int, default=256)
+    parser.add_argument("--n_probe", type=int, default=8)
+    parser.add_argument("--window_radius", type=int, default=None, help='only compare test patches with train '
+                                                                        'patches within this many cells')
+    parser.add_argument("--coreset", type=float, default=None, help='ratio (<= 1) or number of train images to keep')
+    parser.add_argument("--patch_coreset", type=float, default=None, help='ratio (<= 1) or number of patches per layer '
+                                                                          'to keep in the --ann index')
+
+
+def parse_args(argv=None):
+    """Arguments of a subcommand; without one, the arguments are those of evaluate"""
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if not argv or argv[0] not in COMMANDS + ['-h', '--help']:
+        argv = ['evaluate'] + argv
 
+    parser = argparse.ArgumentParser('SPADE')
+    subparsers = parser.add_subparsers(dest='command')
+
+    extract_parser = subparsers.add_parser('extract', help='extract features into the feature caches')
+    add_bank_args(extract_parser)
+    extract_parser.add_argument("--phase", type=str, default='train', choices=['train', 'test', 'both'])
+
+    fit_parser = subparsers.add_parser('fit', help='fit a detector per class and save it to <save_path>/models')
+    add_bank_args(fit_parser)
+
+    parser_ = subparsers.add_parser('evaluate', help='fit and evaluate on the MVTec AD test sets (default)')
+    add_bank_args(parser_)
+    parser_.add_argument("--precision_report", action='store_true', help='also score with a float32 bank and '
+                                                                         'float32 distances')
+    parser_.add_argument("--coreset_report", action='store_true', help='also score with the full bank')
+    parser_.add_argument("--save_model", action='store_true', help='save a SpadeDetector artifact per class')
+    parser_.add_argument("--pixel_metric", type=str, default='exact', choices=['exact', 'histogram'])
+    parser_.add_argument("--n_bins", type=int, default=16384)
+    parser_.add_argument("--vis_num", type=int, default=5, help='number of test images visualized per class')
+    parser_.add_argument("--no-vis", dest='no_vis', action='store_true', help='do not render localization results')
+    parser_.add_argument("--vis_workers", type=int, default=1)
+    parser_.add_argument("--workers", type=int, default=1, help='number of classes evaluated in parallel (cpu only)')
+    parser_.add_argument("--threads_per_worker", type=int, default=None)
+    parser_.add_argument("--shards", type=int, default=1, help='split the train feature bank across this many '
+                                                                'processes (gloo on localhost, cpu)')
+    parser_.add_argument("--shard_timeout", type=int, default=120, help='seconds after which a collective of '
+                         'the shards fails, so that a dead or stuck shard stops the run instead of blocking it')
+    parser_.add_argument("--profile", action='store_true', help='record time and peak memory per stage and class '
+                                                                'to <save_path>/profile.json')
+    parser_.add_argument("--profile_trace", action='store_true', help='also write a torch profiler Chrome trace '
+                                                                      'per class to <save_path>/profile')
+
+    predict_parser = subparsers.add_parser('predict', help='score image files with a saved detector')
+    predict_parser.add_argument("images", type=str, nargs='+')
+    predict_parser.add_argument("--class_name", type=str, required=True)
+    predict_parser.add_argument("--model_dir", type=str, default='./result/models')
+    predict_parser.add_argument("--compile", type=str, default='none', choices=COMPILE_MODES)
+    predict_parser.add_argument("--extractor_path", type=str, default=None, help='extractor exported by export.py')
+    predict_parser.add_argument("--score_map_dir", type=str, default=None, help='also save score maps as .npy')
+
+    plot_parser = subparsers.add_parser('plot', help='plot the ROC curves of the last evaluate')
+    plot_parser.add_argument("--save_path", type=str, default="./result")
+
+    args = parser.parse_args(argv)
+    if getattr(args, 'ann', False) and args.window_radius is not None:
+        parser.error('--window_radius cannot be combined with --ann')
+    if getattr(args, 'shards', 1) > 1 and (args.ann or args.workers > 1):
+        parser.error('--shards cannot be combined with --ann or --workers')
+    return args
+
+
+def report_startup(command):
+    """Print the time spent on module imports and until the command had its models ready"""
+    print('| startup | %s | imports %.3f s | ready after %.3f s |' % (
+        command, IMPORT_SECONDS, time.perf_counter() - START_TIME), file=sys.stderr)
+
+
+def default_device():
+    import torch
+    return 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+def load_model(args, device):
+    """Feature extractor: exported by export.py, or wide_resnet50_2 without the classification head"""
+    from extractor import build_extractor, load_extractor
+    if args.extractor_path is not None:
+        return load_extractor(args.extractor_path, device)
+    return build_extractor(device, compile_mode=args.compile)
 
-def main():
 
+def main():
     args = parse_args()
-
-    # device setup
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-
-    # load model
-    model = wide_resnet50_2(pretrained=True, progress=True)
-    model.to(device)
-    model.eval()
-
-    # set model's intermediate outputs
-    outputs = []
-    def hook(module, input, output):
-        outputs.append(output)
-    model.layer1[-1].register_forward_hook(hook)
-    model.layer2[-1].register_forward_hook(hook)
-    model.layer3[-1].register_forward_hook(hook)
-    model.avgpool.register_forward_hook(hook)
-
+    {'extract': extract_command, 'fit': fit_command, 'evaluate': evaluate_command,
+     'predict': predict_command, 'plot': plot_command}[args.command](args)
+
+
+def extract_command(args):
+    """Fill the train (content-addressed) and test feature caches of each class"""
+    import datasets.mvtec as mvtec
+    from feature_cache import keys_digest, save_features
+
+    device = default_device()
+    model = load_model(args, device)
+    report_startup('extract')
+    data_cache_dir = os.path.join(args.save_path, 'temp', 'data') if args.data_cache else None
+    for class_name in args.class_names:
+        if args.phase in ['train', 'both']:
+            train_dataset = mvtec.MVTecDataset(class_name=class_name, is_train=True, cache_dir=data_cache_dir,
+                                               uint8=args.uint8, **dataset_options(args))
+            build_detector(args, device, model, coreset=None, ann=False, image_index='brute').fit(
+                train_dataset, cache_dir=train_feature_dir(args.save_path, class_name, args.cache_dtype))
+        if args.phase in ['test', 'both']:
+            test_dataset = mvtec.MVTecDataset(class_name=class_name, is_train=False, cache_dir=data_cache_dir,
+                                              uint8=args.uint8, **dataset_options(args))
+            test_outputs = build_detector(args, device, model).extract_dataset(
+                test_dataset, '| feature extraction | test | %s |' % class_name)
+            # test features are queries: always float32, tied to the content of the test images
+            _, keys = test_dataset.image_keys()
+            save_features(test_feature_dir(args.save_path, class_name), test_outputs, dtype='float32',
+                          class_name=class_name, source=keys_digest(keys))
+
+
+def fit_command(args):
+    """Fit a detector on the train set of each class and save it to <save_path>/models/<class>"""
+    import datasets.mvtec as mvtec
+
+    device = default_device()
+    model = load_model(args, device)
+    report_startup('fit')
+    data_cache_dir = os.path.join(args.save_path, 'temp', 'data') if args.data_cache else None
+    for class_name in args.class_names:
+        train_dataset = mvtec.MVTecDataset(class_name=class_name, is_train=True, cache_dir=data_cache_dir,
+                                           uint8=args.uint8, **dataset_options(args))
+        detector = build_detector(args, device, model).fit(
+            train_dataset, cache_dir=train_feature_dir(args.save_path, class_name, args.cache_dtype))
+        detector.save(os.path.join(args.save_path, 'models', class_name))
+        print('saved detector to: %s' % os.path.join(args.save_path, 'models', class_name))
+
+
+def predict_command(args):
+    """Score image files with a saved detector, one JSON line per image on stdout"""
+    import numpy as np
+    import torch
+    from detector import SpadeDetector
+    from extractor import load_uint8_image
+
+    device = default_device()
+    detector = SpadeDetector.load(os.path.join(args.model_dir, args.class_name), device=device,
+                                  extractor=load_model(args, device))
+    report_startup('predict')
+    images = torch.stack([load_uint8_image(path) for path in args.images])
+    scores, score_maps = detector.predict(images)
+    if args.score_map_dir is not None:
+        os.makedirs(args.score_map_dir, exist_ok=True)
+    for path, score, score_map in zip(args.images, scores, score_maps):
+        result = {'image': path, 'class_name': args.class_name, 'score': float(score)}
+        if args.score_map_dir is not None:
+            result['score_map'] = os.path.join(args.score_map_dir,
+                                               os.path.splitext(os.path.basename(path))[0] + '.npy')
+            np.save(result['score_map'], score_map)
+        print(json.dumps(result))
+
+
+def evaluate_command(args):
+    """Fit and evaluate every class, then save the results, reports and ROC curves"""
+    import multiprocessing as mp
+    import numpy as np
+    import datasets.mvtec as mvtec
+    from visualize import VisualizationWriter
+
+    device = default_device()
+    model = load_model(args, device)
+    report_startup('evaluate')
     os.makedirs(os.path.join(args.save_path, 'temp'), exist_ok=True)
 
+    # localization results are rendered in the background while the next classes are scored
+    writer = None if args.no_vis else VisualizationWriter(n_workers=args.vis_workers)
+
+    if args.workers > 1 and device == 'cpu':
+        # extract every class before forking, so that the workers do not stream the archive concurrently
+        for class_name in args.class_names:
+            mvtec.MVTecDataset(class_name=class_name, is_train=True, **dataset_options(args))
+        threads = args.threads_per_worker or max(1, (os.cpu_count() or 1) // args.workers)
+        # forked workers share the model weights copy-on-write, without pickling them
+        ctx = mp.get_context('fork')
+        pool = ctx.Pool(args.workers, initializer=init_worker, initargs=(args, device, model, threads))
+        class_results = pool.imap(evaluate_class_in_worker, args.class_names)
+    else:
+        if args.workers > 1:
+            print('--workers is only supported on cpu, evaluate classes one after another')
+        pool = None
+        class_results = (evaluate_class(class_name, args, device, model) for class_name in args.class_names)
+
+    results = []
+    for result in class_results:
+        vis = result.pop('vis')
+        if writer is not None:
+            writer.submit(*vis, save_path=args.save_path, class_name=result['class_name'])
+        results.append(result)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if args.profile or args.profile_trace:
+        save_profile(results, device, time.perf_counter() - START_TIME,
+                     os.path.join(args.save_path, 'profile.json'))
+
+    print('Average ROCAUC: %.3f' % np.mean([result['roc_auc'] for result in results]))
+    print('Average pixel ROCUAC: %.3f' % np.mean([result['pixel_roc_auc'] for result in results]))
+
+    reports = {'coreset_report': [], 'precision_report': []}
+    for result in results:
+        for name, report in reports.items():
+            if name in result:
+                report.append(result.pop(name))
+    for name, report in reports.items():
+        if report:
+            with open(os.path.join(args.save_path, '%s.json' % name), 'w') as f:
+                json.dump(report, f, indent=2)
+
+    save_results(results, os.path.join(args.save_path, 'results.json'))
+    plot_command(args)
+
+    if writer is not None:
+        writer.close()
+
+
+def thin_curve(x, y, max_points=2000):
+    """At most max_points evenly spaced points of a curve, keeping both ends, as lists"""
+    import numpy as np
+    if len(x) > max_points:
+        keep = np.unique(np.linspace(0, len(x) - 1, max_points).round().astype(int))
+        x, y = np.asarray(x)[keep], np.asarray(y)[keep]
+    return np.asarray(x).tolist(), np.asarray(y).tolist()
+
+
+def save_results(results, path):
+    """ROCAUCs and (thinned) ROC curves of all classes as JSON, read by the plot command"""
+    classes = []
+    for result in results:
+        fpr, tpr = thin_curve(result['fpr'], result['tpr'])
+        pixel_fpr, pixel_tpr = thin_curve(result['pixel_fpr'], result['pixel_tpr'])
+        classes.append({'class_name': result['class_name'], 'roc_auc': result['roc_auc'],
+                        'pixel_roc_auc': result['pixel_roc_auc'], 'fpr': fpr, 'tpr': tpr,
+                        'pixel_fpr': pixel_fpr, 'pixel_tpr': pixel_tpr})
+    with open(path, 'w') as f:
+        json.dump(classes, f)
+
+
+def plot_command(args):
+    """Plot the image and pixel ROC curves in <save_path>/results.json to <save_path>/roc_curve.png"""
+    import numpy as np
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    if args.command == 'plot':
+        report_startup('plot')
+    with open(os.path.join(args.save_path, 'results.json')) as f:
+        results = json.load(f)
+
     fig, ax = plt.subplots(1, 2, figsize=(20, 10))
     fig_img_rocauc = ax[0]
     fig_pixel_rocauc = ax[1]
@@ -55,186 +305,271 @@ def main():
     total_roc_auc = []
     total_pixel_roc_auc = []
 
-    for class_name in mvtec.CLASS_NAMES:
-
-        train_dataset = mvtec.MVTecDataset(class_name=class_name, is_train=True)
-        train_dataloader = DataLoader(train_dataset, batch_size=32, pin_memory=True)
-        test_dataset = mvtec.MVTecDataset(class_name=class_name, is_train=False)
-        test_dataloader = DataLoader(test_dataset, batch_size=32, pin_memory=True)
-
-        train_outputs = OrderedDict([('layer1', []), ('layer2', []), ('layer3', []), ('avgpool', [])])
-        test_outputs = OrderedDict([('layer1', []), ('layer2', []), ('layer3', []), ('avgpool', [])])
-
-        # extract train set features
-        train_feature_filepath = os.path.join(args.save_path, 'temp', 'train_%s.pkl' % class_name)
-        if not os.path.exists(train_feature_filepath):
-            for (x, y, mask) in tqdm(train_dataloader, '| feature extraction | train | %s |' % class_name):
-                # model prediction
-                with torch.no_grad():
-                    pred = model(x.to(device))
-                # get intermediate layer outputs
-                for k, v in zip(train_outputs.keys(), outputs):
-                    train_outputs[k].append(v)
-                # initialize hook outputs
-                outputs = []
-            for k, v in train_outputs.items():
-                train_outputs[k] = torch.cat(v, 0)
-            # save extracted feature
-            with open(train_feature_filepath, 'wb') as f:
-                pickle.dump(train_outputs, f)
-        else:
-            print('load train set feature from: %s' % train_feature_filepath)
-            with open(train_feature_filepath, 'rb') as f:
-                train_outputs = pickle.load(f)
-
-        gt_list = []
-        gt_mask_list = []
-        test_imgs = []
-
-        # extract test set features
-        for (x, y, mask) in tqdm(test_dataloader, '| feature extraction | test | %s |' % class_name):
-            test_imgs.extend(x.cpu().detach().numpy())
-            gt_list.extend(y.cpu().detach().numpy())
-            gt_mask_list.extend(mask.cpu().detach().numpy())
-            # model prediction
-            with torch.no_grad():
-                pred = model(x.to(device))
-            # get intermediate layer outputs
-            for k, v in zip(test_outputs.keys(), outputs):
-                test_outputs[k].append(v)
-            # initialize hook outputs
-            outputs = []
-        for k, v in test_outputs.items():
-            test_outputs[k] = torch.cat(v, 0)
-
-        # calculate distance matrix
-        dist_matrix = calc_dist_matrix(torch.flatten(test_outputs['avgpool'], 1),
-                                       torch.flatten(train_outputs['avgpool'], 1))
-
-        # select K nearest neighbor and take average
-        topk_values, topk_indexes = torch.topk(dist_matrix, k=args.top_k, dim=1, largest=False)
-        scores = torch.mean(topk_values, 1).cpu().detach().numpy()
-
-        # calculate image-level ROC AUC score
-        fpr, tpr, _ = roc_curve(gt_list, scores)
-        roc_auc = roc_auc_score(gt_list, scores)
-        total_roc_auc.append(roc_auc)
-        print('%s ROCAUC: %.3f' % (class_name, roc_auc))
-        fig_img_rocauc.plot(fpr, tpr, label='%s ROCAUC: %.3f' % (class_name, roc_auc))
-
-        score_map_list = []
-        for t_idx in tqdm(range(test_outputs['avgpool'].shape[0]), '| localization | test | %s |' % class_name):
-            score_maps = []
-            for layer_name in ['layer1', 'layer2', 'layer3']:  # for each layer
-
-                # construct a gallery of features at all pixel locations of the K nearest neighbors
-                topk_feat_map = train_outputs[layer_name][topk_indexes[t_idx]]
-                test_feat_map = test_outputs[layer_name][t_idx:t_idx + 1]
-                feat_gallery = topk_feat_map.transpose(3, 1).flatten(0, 2).unsqueeze(-1).unsqueeze(-1)
-
-                # calculate distance matrix
-                dist_matrix_list = []
-                for d_idx in range(feat_gallery.shape[0] // 100):
-                    dist_matrix = torch.pairwise_distance(feat_gallery[d_idx * 100:d_idx * 100 + 100], test_feat_map)
-                    dist_matrix_list.append(dist_matrix)
-                dist_matrix = torch.cat(dist_matrix_list, 0)
-
-                # k nearest features from the gallery (k=1)
-                score_map = torch.min(dist_matrix, dim=0)[0]
-                score_map = F.interpolate(score_map.unsqueeze(0).unsqueeze(0), size=224,
-                                          mode='bilinear', align_corners=False)
-                score_maps.append(score_map)
-
-            # average distance between the features
-            score_map = torch.mean(torch.cat(score_maps, 0), dim=0)
-
-            # apply gaussian smoothing on the score map
-            score_map = gaussian_filter(score_map.squeeze().cpu().detach().numpy(), sigma=4)
-            score_map_list.append(score_map)
-
-        flatten_gt_mask_list = np.concatenate(gt_mask_list).ravel()
-        flatten_score_map_list = np.concatenate(score_map_list).ravel()
-
-        # calculate per-pixel level ROCAUC
-        fpr, tpr, _ = roc_curve(flatten_gt_mask_list, flatten_score_map_list)
-        per_pixel_rocauc = roc_auc_score(flatten_gt_mask_list, flatten_score_map_list)
-        total_pixel_roc_auc.append(per_pixel_rocauc)
-        print('%s pixel ROCAUC: %.3f' % (class_name, per_pixel_rocauc))
-        fig_pixel_rocauc.plot(fpr, tpr, label='%s ROCAUC: %.3f' % (class_name, per_pixel_rocauc))
-
-        # get optimal threshold
-        precision, recall, thresholds = precision_recall_curve(flatten_gt_mask_list, flatten_score_map_list)
-        a = 2 * precision * recall
-        b = precision + recall
-        f1 = np.divide(a, b, out=np.zeros_like(a), where=b != 0)
-        threshold = thresholds[np.argmax(f1)]
+    for result in results:
+        class_name = result['class_name']
+        total_roc_auc.append(result['roc_auc'])
+        fig_img_rocauc.plot(result['fpr'], result['tpr'], label='%s ROCAUC: %.3f' % (class_name, result['roc_auc']))
+        total_pixel_roc_auc.append(result['pixel_roc_auc'])
+        fig_pixel_rocauc.plot(result['pixel_fpr'], result['pixel_tpr'],
+                              label='%s ROCAUC: %.3f' % (class_name, result['pixel_roc_auc']))
 
-        # visualize localization result
-        visualize_loc_result(test_imgs, gt_mask_list, score_map_list, threshold, args.save_path, class_name, vis_num=5)
-
-    print('Average ROCAUC: %.3f' % np.mean(total_roc_auc))
     fig_img_rocauc.title.set_text('Average image ROCAUC: %.3f' % np.mean(total_roc_auc))
     fig_img_rocauc.legend(loc="lower right")
 
-    print('Average pixel ROCUAC: %.3f' % np.mean(total_pixel_roc_auc))
     fig_pixel_rocauc.title.set_text('Average pixel ROCAUC: %.3f' % np.mean(total_pixel_roc_auc))
     fig_pixel_rocauc.legend(loc="lower right")
 
     fig.tight_layout()
     fig.savefig(os.path.join(args.save_path, 'roc_curve.png'), dpi=100)
-
-
-def calc_dist_matrix(x, y):
-    """Calculate Euclidean distance matrix with torch.tensor"""
-    n = x.size(0)
-    m = y.size(0)
-    d = x.size(1)
-    x = x.unsqueeze(1).expand(n, m, d)
-    y = y.unsqueeze(0).expand(n, m, d)
-    dist_matrix = torch.sqrt(torch.pow(x - y, 2).sum(2))
-    return dist_matrix
-
-
-def visualize_loc_result(test_imgs, gt_mask_list, score_map_list, threshold,
-                         save_path, class_name, vis_num=5):
-
-    for t_idx in range(vis_num):
-        test_img = test_imgs[t_idx]
-        test_img = denormalization(test_img)
-        test_gt = gt_mask_list[t_idx].transpose(1, 2, 0).squeeze()
-        test_pred = score_map_list[t_idx]
-        test_pred[test_pred <= threshold] = 0
-        test_pred[test_pred > threshold] = 1
-        test_pred_img = test_img.copy()
-        test_pred_img[test_pred == 0] = 0
-
-        fig_img, ax_img = plt.subplots(1, 4, figsize=(12, 4))
-        fig_img.subplots_adjust(left=0, right=1, bottom=0, top=1)
-
-        for ax_i in ax_img:
-            ax_i.axes.xaxis.set_visible(False)
-            ax_i.axes.yaxis.set_visible(False)
-
-        ax_img[0].imshow(test_img)
-        ax_img[0].title.set_text('Image')
-        ax_img[1].imshow(test_gt, cmap='gray')
-        ax_img[1].title.set_text('GroundTruth')
-        ax_img[2].imshow(test_pred, cmap='gray')
-        ax_img[2].title.set_text('Predicted mask')
-        ax_img[3].imshow(test_pred_img)
-        ax_img[3].title.set_text('Predicted anomalous image')
-
-        os.makedirs(os.path.join(save_path, 'images'), exist_ok=True)
-        fig_img.savefig(os.path.join(save_path, 'images', '%s_%03d.png' % (class_name, t_idx)), dpi=100)
-        fig_img.clf()
-        plt.close(fig_img)
-
-
-def denormalization(x):
-    mean = np.array([0.485, 0.456, 0.406])
-    std = np.array([0.229, 0.224, 0.225])
-    x = (((x.transpose(1, 2, 0) * std) + mean) * 255.).astype(np.uint8)
-    return x
+    plt.close(fig)
+
+
+_worker_state = {}
+
+
+def init_worker(args, device, model, threads):
+    import torch
+    torch.set_num_threads(threads)
+    # pool workers are daemonic and cannot start DataLoader workers
+    args.num_workers = 0
+    _worker_state.update(args=args, device=device, model=model)
+
+
+def evaluate_class_in_worker(class_name):
+    return evaluate_class(class_name, _worker_state['args'], _worker_state['device'], _worker_state['model'])
+
+
+def save_profile(results, device, wall_seconds, path):
+    """Write the per-class stage profiles and their totals over all classes as JSON"""
+    total = {}
+    for result in results:
+        for name, stats in result['profile']['stages'].items():
+            acc = total.setdefault(name, dict(stats, calls=0, wall_seconds=0., cpu_seconds=0.))
+            acc['calls'] += stats['calls']
+            acc['wall_seconds'] += stats['wall_seconds']
+            acc['cpu_seconds'] += stats['cpu_seconds']
+            for key in ['peak_rss_mb', 'peak_cuda_mb']:
+                if key in stats:
+                    acc[key] = max(acc[key], stats[key])
+    summary = {'device': device, 'wall_seconds': wall_seconds, 'stages': total,
+               'classes': [dict(result['profile'], class_name=result['class_name']) for result in results]}
+    with open(path, 'w') as f:
+        json.dump(summary, f, indent=2)
+    print('profile saved to: %s' % path)
+
+
+def evaluate_class(class_name, args, device, model):
+    """Fit a detector on the train set of one class and evaluate it on its test set"""
+    from profiler import StageProfiler, trace
+
+    profiler = StageProfiler(device, enabled=args.profile or args.profile_trace)
+    trace_path = os.path.join(args.save_path, 'profile', 'trace_%s.json' % class_name)
+    with trace(trace_path, device, enabled=args.profile_trace):
+        result = _evaluate_class(class_name, args, device, model, profiler)
+    if profiler.enabled:
+        print('%s profile:\n%s' % (class_name, profiler.report()))
+    return result
+
+
+def _evaluate_class(class_name, args, device, model, profiler):
+    from collections import OrderedDict
+    from contextlib import nullcontext
+
+    import numpy as np
+    from tqdm import tqdm
+    import datasets.mvtec as mvtec
+    from datasets.loader import ThroughputMeter, make_dataloader
+    from extractor import normalize
+    from feature_cache import as_tensor, bank_nbytes, keys_digest, load_features, load_meta
+    from metrics import ScoreAccumulator
+
+    data_cache_dir = os.path.join(args.save_path, 'temp', 'data') if args.data_cache else None
+    train_dataset = mvtec.MVTecDataset(class_name=class_name, is_train=True, cache_dir=data_cache_dir,
+                                       uint8=args.uint8, **dataset_options(args))
+    test_dataset = mvtec.MVTecDataset(class_name=class_name, is_train=False, cache_dir=data_cache_dir,
+                                      uint8=args.uint8, **dataset_options(args))
+    test_dataloader = ThroughputMeter(make_dataloader(test_dataset, batch_size=32, num_workers=args.num_workers,
+                                                      prefetch_factor=args.prefetch_factor))
+
+    # build the train feature bank
+    with profiler.stage('fit'):
+        detector = build_detector(args, device, model).fit(
+            train_dataset, cache_dir=train_feature_dir(args.save_path, class_name, args.cache_dtype))
+    if args.save_model:
+        detector.save(os.path.join(args.save_path, 'models', class_name))
+
+    # reference detectors scored on the same test features: [detector, image metric, pixel metric]
+    references = {}
+    if args.coreset is not None and args.coreset_report:
+        with profiler.stage('fit_full_bank'):
+            references['full_bank'] = [build_detector(args, device, model, coreset=None).fit(
+                train_dataset, cache_dir=train_feature_dir(args.save_path, class_name, args.cache_dtype))]
+    if args.precision_report:
+        with profiler.stage('fit_float32'):
+            references['float32'] = [build_detector(args, device, model, cache_dtype='float32',
+                                                    dist_dtype='float32').fit(
+                train_dataset, cache_dir=train_feature_dir(args.save_path, class_name, 'float32'))]
+    for reference in references.values():
+        reference.extend([ScoreAccumulator(), build_pixel_metric(args)])
+
+    img_metric = ScoreAccumulator()
+    pixel_metric = build_pixel_metric(args)
+    vis_num = 0 if args.no_vis else args.vis_num
+    vis_imgs, vis_masks, vis_score_maps = [], [], []
+
+    # test features written by the extract command, if they were extracted from the same test images
+    test_features = None
+    if load_meta(test_feature_dir(args.save_path, class_name)) is not None:
+        _, keys = test_dataset.image_keys()
+        test_features = load_features(test_feature_dir(args.save_path, class_name), class_name=class_name,
+                                      source=keys_digest(keys))
+        if test_features is not None:
+            print('load test set feature from: %s' % test_feature_dir(args.save_path, class_name))
+
+    # processes holding one part of the bank each, which search it together for every test batch,
+    # closed even if scoring fails so that the shard workers do not wait for rank 0 forever
+    sharding = nullcontext()
+    if args.shards > 1:
+        from sharded import ShardedDetector
+        sharding = ShardedDetector.start(detector.feature_dir, args.shards, detector.config(),
+                                         threads_per_shard=args.threads_per_worker, timeout=args.shard_timeout)
+
+    # score each test batch as soon as its features are extracted
+    with sharding as sharded:
+        n_scored = 0
+        desc = '| feature extraction + localization | test | %s |' % class_name
+        for (x, y, mask) in tqdm(test_dataloader, desc):
+            with profiler.stage('test_extraction'):
+                if test_features is not None:
+                    test_outputs = OrderedDict((name, as_tensor(feat[n_scored:n_scored + x.size(0)], device))
+                                               for name, feat in test_features.items())
+                else:
+                    test_outputs = detector.extract(x)
+            n_scored += x.size(0)
+            if sharded is not None:
+                with profiler.stage('sharded_scoring'):
+                    scores, score_maps = sharded.score(test_outputs)
+            else:
+                with profiler.stage('image_knn'):
+                    scores, topk_indexes = detector.image_scores(test_outputs)
+                with profiler.stage('localization'):
+                    score_maps = detector.score_maps(test_outputs, topk_indexes)
+            with profiler.stage('metrics'):
+                img_metric.update(y.numpy(), scores)
+                pixel_metric.update(mask.numpy(), np.stack(score_maps))
+            for name, (reference, ref_img_metric, ref_pixel_metric) in references.items():
+                with profiler.stage('%s_scoring' % name):
+                    ref_scores, ref_score_maps = reference.score(test_outputs)
+                    ref_img_metric.update(y.numpy(), ref_scores)
+                    ref_pixel_metric.update(mask.numpy(), np.stack(ref_score_maps))
+
+            # keep a bounded sample for visualization
+            n_vis = min(x.size(0), vis_num - len(vis_imgs))
+            vis_imgs.extend((normalize(x[:n_vis]) if args.uint8 else x[:n_vis]).numpy())
+            vis_masks.extend(mask[:n_vis].numpy())
+            vis_score_maps.extend(score_maps[:n_vis])
+            del test_outputs
+    print('%s test loader: %s' % (class_name, test_dataloader.report()))
+
+    # calculate image-level ROC AUC score
+    with profiler.stage('metrics'):
+        fpr, tpr, _ = img_metric.roc_curve()
+        roc_auc = img_metric.roc_auc()
+    print('%s ROCAUC: %.3f' % (class_name, roc_auc))
+    result = {'class_name': class_name, 'roc_auc': roc_auc, 'fpr': fpr, 'tpr': tpr}
+
+    # calculate per-pixel level ROCAUC
+    with profiler.stage('metrics'):
+        fpr, tpr, _ = pixel_metric.roc_curve()
+        per_pixel_rocauc = pixel_metric.roc_auc()
+    if args.pixel_metric == 'histogram':
+        print('%s pixel ROCAUC: %.3f (error bound %.4f)' % (class_name, per_pixel_rocauc,
+                                                            pixel_metric.roc_auc_error_bound()))
+    else:
+        print('%s pixel ROCAUC: %.3f' % (class_name, per_pixel_rocauc))
+    result.update(pixel_roc_auc=per_pixel_rocauc, pixel_fpr=fpr, pixel_tpr=tpr)
+
+    # get optimal threshold
+    with profiler.stage('metrics'):
+        threshold = pixel_metric.best_f1_threshold()
+
+    # compare against the full train bank
+    if 'full_bank' in references:
+        full_detector, full_img_metric, full_pixel_metric = references['full_bank']
+        full_rocauc = full_img_metric.roc_auc()
+        full_pixel_rocauc = full_pixel_metric.roc_auc()
+        result['coreset_report'] = {'class_name': class_name,
+                                    'train_size': len(full_detector.train_outputs['avgpool']),
+                                    'coreset_size': len(detector.train_outputs['avgpool']),
+                                    'full_rocauc': full_rocauc,
+                                    'coreset_rocauc': roc_auc,
+                                    'full_pixel_rocauc': full_pixel_rocauc,
+                                    'coreset_pixel_rocauc': per_pixel_rocauc}
+        print('%s coreset ROCAUC delta: %+.3f, pixel ROCAUC delta: %+.3f' % (
+            class_name, roc_auc - full_rocauc, per_pixel_rocauc - full_pixel_rocauc))
+
+    # compare against float32 storage and distances
+    if 'float32' in references:
+        ref_detector, ref_img_metric, ref_pixel_metric = references['float32']
+        ref_rocauc = ref_img_metric.roc_auc()
+        ref_pixel_rocauc = ref_pixel_metric.roc_auc()
+        result['precision_report'] = {'class_name': class_name,
+                                      'cache_dtype': args.cache_dtype,
+                                      'dist_dtype': args.dist_dtype,
+                                      'bank_mb': bank_nbytes(detector.train_outputs) / 1024 ** 2,
+                                      'float32_bank_mb': bank_nbytes(ref_detector.train_outputs) / 1024 ** 2,
+                                      'rocauc': roc_auc,
+                                      'float32_rocauc': ref_rocauc,
+                                      'pixel_rocauc': per_pixel_rocauc,
+                                      'float32_pixel_rocauc': ref_pixel_rocauc}
+        print('%s %s/%s ROCAUC delta: %+.4f, pixel ROCAUC delta: %+.4f' % (
+            class_name, args.cache_dtype, args.dist_dtype, roc_auc - ref_rocauc, per_pixel_rocauc - ref_pixel_rocauc))
+
+    # samples for visualizing the localization result
+    result['vis'] = (vis_imgs, vis_masks, vis_score_maps, threshold)
+
+    if profiler.enabled:
+        result['profile'] = {'stages': profiler.summary(), 'test_loader_wait_seconds': test_dataloader.wait_time,
+                             'test_loader_seconds': test_dataloader.total_time}
+
+    return result
+
+
+def train_feature_dir(save_path, class_name, cache_dtype):
+    """Feature cache directory of a class, one per storage dtype so that banks of several dtypes coexist"""
+    if cache_dtype == 'float32':
+        return os.path.join(save_path, 'temp', 'train_%s' % class_name)
+    return os.path.join(save_path, 'temp', 'train_%s_%s' % (class_name, cache_dtype))
+
+
+def dataset_options(args):
+    """Checks of the dataset download and extraction, as MVTecDataset keyword arguments"""
+    return {'archive_sha256': args.archive_sha256, 'verify': args.verify_dataset}
+
+
+def test_feature_dir(save_path, class_name):
+    """Feature cache of the test images of a class written by the extract command, always float32"""
+    return os.path.join(save_path, 'temp', 'test_%s' % class_name)
+
+
+def build_pixel_metric(args):
+    """Accumulator for pixel-level metrics: exact, or bounded-memory histogram"""
+    from metrics import HistogramScoreAccumulator, ScoreAccumulator
+    if args.pixel_metric == 'histogram':
+        return HistogramScoreAccumulator(n_bins=args.n_bins)
+    return ScoreAccumulator()
+
+
+def build_detector(args, device, extractor, **kwargs):
+    """SpadeDetector configured from the command line arguments"""
+    from detector import SpadeDetector
+    config = dict(top_k=args.top_k, memory_budget_mb=args.memory_budget_mb, tile_size=args.tile_size,
+                  cache_dtype=args.cache_dtype, dist_dtype=args.dist_dtype, coreset=args.coreset,
+                  image_index=args.image_index, image_n_lists=args.image_n_lists, ann=args.ann,
+                  n_lists=args.n_lists, n_probe=args.n_probe, patch_coreset=args.patch_coreset,
+                  window_radius=args.window_radius, compile_mode=args.compile)
+    config.update(kwargs)
+    return SpadeDetector(device=device, extractor=extractor, num_workers=args.num_workers, **config)
 
 
 if __name__ == '__main__':
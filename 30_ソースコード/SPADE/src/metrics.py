@@ -0,0 +1,147 @@
+import numpy as np
+
+
+class _CurveMixin:
+    """ROC / PR metrics from true and false positive counts at descending thresholds
+
+    Subclasses implement _counts(), returning (tps, fps, thresholds) where tps[i]
+    and fps[i] count the positives and negatives with score >= thresholds[i].
+    """
+
+    def roc_curve(self):
+        """(fpr, tpr, thresholds), as sklearn.metrics.roc_curve with drop_intermediate=False"""
+        tps, fps, thresholds = self._counts()
+        tps = np.r_[0, tps]
+        fps = np.r_[0, fps]
+        thresholds = np.r_[np.inf, thresholds]
+        return fps / max(fps[-1], 1), tps / max(tps[-1], 1), thresholds
+
+    def roc_auc(self):
+        """Area under the ROC curve, nan if only one class was seen (sklearn raises there)"""
+        tps, fps, _ = self._counts()
+        if len(tps) == 0 or tps[-1] == 0 or fps[-1] == 0:
+            return float('nan')
+        fpr, tpr, _ = self.roc_curve()
+        # trapezoidal rule, as sklearn.metrics.auc
+        return float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2))
+
+    def pr_curve(self):
+        """(precision, recall, thresholds) in the order of sklearn.metrics.precision_recall_curve"""
+        tps, fps, thresholds = self._counts()
+        precision = tps / np.maximum(tps + fps, 1)
+        recall = tps / max(tps[-1], 1)
+        # reverse to increasing thresholds
+        return np.r_[precision[::-1], 1], np.r_[recall[::-1], 0], thresholds[::-1]
+
+    def best_f1_threshold(self):
+        """Score threshold with the highest F1 score (pixels with score >= threshold are anomalous)"""
+        tps, fps, thresholds = self._counts()
+        precision = tps / np.maximum(tps + fps, 1)
+        recall = tps / max(tps[-1], 1)
+        a = 2 * precision * recall
+        b = precision + recall
+        f1 = np.divide(a, b, out=np.zeros_like(a), where=b != 0)
+        return thresholds[np.argmax(f1)]
+
+
+class ScoreAccumulator(_CurveMixin):
+    """Exact running (label, score) pairs for ROC and PR metrics, updated batch by batch
+
+    Labels are kept as uint8 and scores as float32. All metrics are derived from a
+    single descending sort of the scores and match sklearn.metrics up to float32
+    rounding of the scores.
+    """
+
+    def __init__(self):
+        self.labels = []
+        self.scores = []
+        self._sorted = None
+
+    def update(self, labels, scores):
+        self.labels.append(np.asarray(labels).ravel().astype(np.uint8))
+        self.scores.append(np.asarray(scores, dtype=np.float32).ravel())
+        self._sorted = None
+
+    def arrays(self):
+        return np.concatenate(self.labels), np.concatenate(self.scores)
+
+    def _counts(self):
+        if self._sorted is None:
+            labels, scores = self.arrays()
+            order = np.argsort(scores, kind='mergesort')[::-1]
+            labels, scores = labels[order], scores[order]
+            # last index of each distinct score
+            distinct = np.r_[np.where(np.diff(scores))[0], scores.size - 1]
+            tps = np.cumsum(labels, dtype=np.int64)[distinct]
+            fps = distinct + 1 - tps
+            self._sorted = (tps, fps, scores[distinct])
+        return self._sorted
+
+
+class HistogramScoreAccumulator(_CurveMixin):
+    """Bounded-memory (label, score) accumulator over a fixed number of score bins
+
+    Scores are counted per label in n_bins equal-width bins. The score range is
+    taken from the first batch and doubled whenever a later score falls outside it,
+    by merging neighbouring bins, so memory stays O(n_bins) for any number of pixels.
+
+    Error bounds relative to sklearn.metrics on the same scores:
+    * roc_auc treats all scores within a bin as ties, so it differs from the exact
+      value by at most roc_auc_error_bound() = sum_b pos_b * neg_b / (2 * P * N).
+    * ROC and PR points are the exact points at the bin edges, a subset of the
+      exact curves' thresholds.
+    * best_f1_threshold is a bin edge, within bin_width() of a threshold achieving
+      the best F1 among bin edges.
+    """
+
+    def __init__(self, n_bins=16384, score_range=None):
+        assert n_bins % 2 == 0, 'n_bins should be even'
+        self.n_bins = n_bins
+        self.pos = np.zeros(n_bins, dtype=np.int64)
+        self.neg = np.zeros(n_bins, dtype=np.int64)
+        self.low, self.high = score_range if score_range is not None else (None, None)
+
+    def bin_width(self):
+        return (self.high - self.low) / self.n_bins
+
+    def _grow(self, low, high):
+        """Double the range until it covers [low, high], merging pairs of bins"""
+        while low < self.low or high >= self.high:
+            width = self.high - self.low
+            half = self.n_bins // 2
+            if high >= self.high:
+                # extend upwards: bins 2i, 2i + 1 become bin i
+                for counts in (self.pos, self.neg):
+                    counts[:half] = counts[0::2] + counts[1::2]
+                    counts[half:] = 0
+                self.high += width
+            else:
+                # extend downwards: bins 2i, 2i + 1 become bin half + i
+                for counts in (self.pos, self.neg):
+                    counts[half:] = counts[0::2] + counts[1::2]
+                    counts[:half] = 0
+                self.low -= width
+
+    def update(self, labels, scores):
+        labels = np.asarray(labels).ravel().astype(bool)
+        scores = np.asarray(scores, dtype=np.float64).ravel()
+        if scores.size == 0:
+            return
+        low, high = scores.min(), scores.max()
+        if self.low is None:
+            self.low, self.high = low, high + max(high - low, 1e-6) / self.n_bins
+        self._grow(low, high)
+        bins = np.minimum(((scores - self.low) / self.bin_width()).astype(np.int64), self.n_bins - 1)
+        self.pos += np.bincount(bins[labels], minlength=self.n_bins)
+        self.neg += np.bincount(bins[~labels], minlength=self.n_bins)
+
+    def _counts(self):
+        nonempty = np.where((self.pos + self.neg)[::-1] > 0)[0]
+        tps = np.cumsum(self.pos[::-1])[nonempty]
+        fps = np.cumsum(self.neg[::-1])[nonempty]
+        edges = self.low + self.bin_width() * np.arange(self.n_bins)
+        return tps, fps, edges[::-1][nonempty]
+
+    def roc_auc_error_bound(self):
+        n_pos, n_neg = self.pos.sum(), self.neg.sum()
+        return float((self.pos * self.neg).sum() / max(2 * n_pos * n_neg, 1))
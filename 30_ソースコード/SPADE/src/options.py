@@ -0,0 +1,13 @@
+# Choices of the command line options, in a module without dependencies so that
+# argument parsing (and --help) does not import torch. The modules implementing
+# them import these names from here.
+
+CLASS_NAMES = ['bottle', 'cable', 'capsule', 'carpet', 'grid',
+               'hazelnut', 'leather', 'metal_nut', 'pill', 'screw',
+               'tile', 'toothbrush', 'transistor', 'wood', 'zipper']
+COMPILE_MODES = ['none', 'jit', 'compile']
+# storage dtypes of a feature cache
+DTYPES = ['float32', 'float16', 'bfloat16', 'int8']
+# dtypes of the distance products
+DIST_DTYPES = ['float32', 'float16', 'bfloat16']
+INDEX_TYPES = ['brute', 'balltree', 'ivf']
@@ -0,0 +1,48 @@
+import torch
+import torch.nn.functional as F
+
+
+def gaussian_kernel1d(sigma, truncate=4.0, device='cpu', dtype=torch.float32):
+    """Normalized 1-D Gaussian kernel of radius int(truncate * sigma + 0.5), as scipy.ndimage"""
+    radius = int(truncate * sigma + 0.5)
+    x = torch.arange(-radius, radius + 1, device=device, dtype=torch.float64)
+    kernel = torch.exp(-0.5 * (x / sigma) ** 2)
+    return (kernel / kernel.sum()).to(dtype)
+
+
+def reflect_pad(x, pad, dim):
+    """Pad x along dim with scipy.ndimage mode='reflect' (d c b a | a b c d | d c b a)"""
+    left, right = [], []
+    remaining = pad
+    while remaining > 0:
+        # each step reflects the current edge, so pads larger than the size repeat the pattern
+        current = torch.cat(left[::-1] + [x] + right, dim) if left else x
+        step = min(remaining, current.size(dim))
+        left.append(current.narrow(dim, 0, step).flip(dim))
+        right.append(current.narrow(dim, current.size(dim) - step, step).flip(dim))
+        remaining -= step
+    return torch.cat(left[::-1] + [x] + right, dim)
+
+
+def gaussian_blur(maps, sigma=4, truncate=4.0):
+    """Separable Gaussian smoothing of a batch of maps (B, H, W), matching scipy.ndimage.gaussian_filter"""
+    kernel = gaussian_kernel1d(sigma, truncate, device=maps.device, dtype=maps.dtype)
+    radius = (kernel.numel() - 1) // 2
+    x = maps.unsqueeze(1)
+    x = F.conv2d(reflect_pad(x, radius, 3), kernel.view(1, 1, 1, -1))
+    x = F.conv2d(reflect_pad(x, radius, 2), kernel.view(1, 1, -1, 1))
+    return x.squeeze(1)
+
+
+def postprocess(layer_score_maps, img_size=224, sigma=4):
+    """Upsample per-layer score maps (B, 1, h, w) to img_size, average them and smooth the result
+
+    Returns a (B, img_size, img_size) tensor on the device of the inputs.
+    """
+    score_maps = 0
+    for score_map in layer_score_maps:
+        score_maps = score_maps + F.interpolate(score_map, size=img_size, mode='bilinear', align_corners=False)
+    score_maps = score_maps.squeeze(1) / len(layer_score_maps)
+    if sigma:
+        score_maps = gaussian_blur(score_maps, sigma=sigma)
+    return score_maps
@@ -0,0 +1,104 @@
+import os
+import time
+from contextlib import contextmanager
+
+import torch
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def _reset_peak_rss():
+    """Reset the peak RSS of this process (Linux only), so it can be read per stage"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB (since the last reset on Linux)"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is not None:
+        # kilobytes on Linux, bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return None
+
+
+class StageProfiler:
+    """Wall time, CPU time and peak memory per named stage, accumulated over repeated entries
+
+    Peak RSS is reset at the start of each stage where the OS allows it (Linux),
+    otherwise it is the peak of the process so far. Stages are also marked with
+    torch.profiler.record_function, so they show up in a torch profiler trace.
+    A disabled profiler records nothing and adds no synchronization.
+    """
+
+    def __init__(self, device='cpu', enabled=True):
+        self.device = device
+        self.enabled = enabled
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        self._sync()
+        rss_reset = _reset_peak_rss()
+        if self.device == 'cuda':
+            torch.cuda.reset_peak_memory_stats()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        with torch.profiler.record_function(name):
+            yield
+        self._sync()
+        stats = self.stages.setdefault(name, {'calls': 0, 'wall_seconds': 0., 'cpu_seconds': 0.,
+                                              'peak_rss_mb': 0., 'peak_rss_reset': rss_reset})
+        stats['calls'] += 1
+        stats['wall_seconds'] += time.perf_counter() - wall_start
+        stats['cpu_seconds'] += time.process_time() - cpu_start
+        stats['peak_rss_mb'] = max(stats['peak_rss_mb'], peak_rss_mb() or 0.)
+        if self.device == 'cuda':
+            stats['peak_cuda_mb'] = max(stats.get('peak_cuda_mb', 0.), torch.cuda.max_memory_allocated() / 1024 ** 2)
+
+    def _sync(self):
+        if self.device == 'cuda':
+            torch.cuda.synchronize()
+
+    def wall_times(self):
+        return {name: stats['wall_seconds'] for name, stats in self.stages.items()}
+
+    def summary(self):
+        return {name: dict(stats) for name, stats in self.stages.items()}
+
+    def report(self):
+        lines = ['%-20s %6s %10s %10s %12s' % ('stage', 'calls', 'wall [s]', 'cpu [s]', 'peak RSS [MB]')]
+        for name, stats in self.stages.items():
+            lines.append('%-20s %6d %10.3f %10.3f %12.1f' % (name, stats['calls'], stats['wall_seconds'],
+                                                             stats['cpu_seconds'], stats['peak_rss_mb']))
+        return '\n'.join(lines)
+
+
+@contextmanager
+def trace(path, device='cpu', enabled=True):
+    """torch profiler over the block, exported as a Chrome trace (chrome://tracing) to path"""
+    if not enabled:
+        yield
+        return
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if device == 'cuda':
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    with torch.profiler.profile(activities=activities, profile_memory=True) as prof:
+        yield
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    prof.export_chrome_trace(path)
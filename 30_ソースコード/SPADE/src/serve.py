@@ -0,0 +1,322 @@
+import argparse
+import base64
+import io
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import torch
+
+from detector import SpadeDetector
+from extractor import COMPILE_MODES, build_extractor, load_extractor, load_uint8_image
+
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('SPADE inference service')
+    parser.add_argument("--model_dir", type=str, default='./result/models', help='detectors saved by '
+                                                                                  'main.py --save_model')
+    parser.add_argument("--class_names", type=str, nargs='+', default=None, help='default: all in --model_dir')
+    parser.add_argument("--host", type=str, default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix_socket", type=str, default=None, help='serve HTTP on this socket path instead')
+    parser.add_argument("--watch_dir", type=str, default=None, help='also score images put in <watch_dir>/<class>')
+    parser.add_argument("--poll_interval", type=float, default=0.2)
+    parser.add_argument("--max_batch_size", type=int, default=32)
+    parser.add_argument("--max_wait_ms", type=float, default=10., help='latency deadline for filling a batch')
+    parser.add_argument("--compile", type=str, default='none', choices=COMPILE_MODES)
+    parser.add_argument("--extractor_path", type=str, default=None, help='extractor exported by export.py')
+    parser.add_argument("--report_interval", type=float, default=30., help='seconds between latency reports')
+    return parser.parse_args()
+
+
+class LatencyStats:
+    """Request latencies (last max_len) and throughput since start, thread-safe"""
+
+    def __init__(self, max_len=100000):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=max_len)
+        self.n_requests = 0
+        self.n_batches = 0
+        self.start = time.perf_counter()
+
+    def record(self, latencies):
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.n_requests += len(latencies)
+            self.n_batches += 1
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            n_requests, n_batches = self.n_requests, self.n_batches
+        elapsed = time.perf_counter() - self.start
+        summary = {'requests': n_requests, 'batches': n_batches, 'throughput': n_requests / elapsed,
+                   'mean_batch_size': n_requests / max(n_batches, 1)}
+        if len(latencies):
+            summary.update(p50_ms=float(np.percentile(latencies, 50)), p99_ms=float(np.percentile(latencies, 99)))
+        return summary
+
+    def report(self):
+        summary = self.summary()
+        return '%d requests, %.1f images/s, mean batch %.1f, p50 %.1f ms, p99 %.1f ms' % (
+            summary['requests'], summary['throughput'], summary['mean_batch_size'],
+            summary.get('p50_ms', float('nan')), summary.get('p99_ms', float('nan')))
+
+
+class MicroBatcher:
+    """Scores single-image requests in batches on one background thread
+
+    A batch is closed when it holds max_batch_size requests or max_wait_ms after
+    its first request arrived, whichever comes first; its requests are then
+    scored per class. Score maps are only computed for batches where one was asked for.
+    """
+
+    def __init__(self, detectors, max_batch_size=32, max_wait_ms=10.):
+        self.detectors = detectors
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.stats = LatencyStats()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, class_name, image, score_map=False):
+        """Future of {'score', 'latency_ms', 'batch_size'[, 'score_map']} for a uint8 image (3, H, W)"""
+        assert class_name in self.detectors, 'no detector for class {}'.format(class_name)
+        future = Future()
+        self.queue.put((time.perf_counter(), class_name, image, score_map, future))
+        return future
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = item[0] + self.max_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    item = self.queue.get(timeout=max(0., deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self._process(batch)
+
+    def _process(self, batch):
+        groups = {}
+        for item in batch:
+            groups.setdefault(item[1], []).append(item)
+        for class_name, items in groups.items():
+            detector = self.detectors[class_name]
+            try:
+                images = torch.stack([item[2] for item in items])
+                test_outputs = detector.extract(images)
+                scores, topk_indexes = detector.image_scores(test_outputs)
+                score_maps = None
+                if any(item[3] for item in items):
+                    score_maps = detector.score_maps(test_outputs, topk_indexes)
+            except Exception as e:
+                for item in items:
+                    item[4].set_exception(e)
+                continue
+            done = time.perf_counter()
+            for idx, (arrival, _, _, score_map, future) in enumerate(items):
+                result = {'class_name': class_name, 'score': float(scores[idx]),
+                          'latency_ms': (done - arrival) * 1000, 'batch_size': len(items)}
+                if score_map:
+                    result['score_map'] = score_maps[idx]
+                future.set_result(result)
+            self.stats.record([done - item[0] for item in items])
+
+
+def encode_score_map(score_map):
+    """Score map as base64 of a float16 .npy file, decode with np.load(io.BytesIO(base64.b64decode(s)))"""
+    buffer = io.BytesIO()
+    np.save(buffer, score_map.astype(np.float16))
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """POST /predict/<class_name>[?score_map=1] with the encoded image as body, GET /stats"""
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/stats':
+            return self.send_json(404, {'error': 'unknown path'})
+        self.send_json(200, self.server.batcher.stats.summary())
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] != 'predict' or parts[1] not in self.server.batcher.detectors:
+            return self.send_json(404, {'error': 'unknown path or class'})
+        score_map = parse_qs(url.query).get('score_map', ['0'])[0] not in ('0', 'false')
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            image = load_uint8_image(io.BytesIO(body))
+        except Exception as e:
+            return self.send_json(400, {'error': 'cannot decode image: %s' % e})
+        result = self.server.batcher.submit(parts[1], image, score_map).result()
+        if score_map:
+            result['score_map'] = encode_score_map(result['score_map'])
+        self.send_json(200, result)
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ('local', 0)
+
+
+class DirectoryWatcher:
+    """Polls <watch_dir>/<class_name>/ for images and scores them through the batcher
+
+    Results are written to <class_name>/results/<name>.json (and <name>.npy with the
+    score map), the image is then moved to <class_name>/done/. Files starting with
+    '.' are ignored, so writers should copy to a hidden name and rename into place.
+    """
+
+    def __init__(self, batcher, watch_dir, poll_interval=0.2, score_map=True):
+        self.batcher = batcher
+        self.watch_dir = watch_dir
+        self.poll_interval = poll_interval
+        self.score_map = score_map
+        self.in_flight = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        for class_name in batcher.detectors:
+            for sub_dir in ['', 'results', 'done']:
+                os.makedirs(os.path.join(watch_dir, class_name, sub_dir), exist_ok=True)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.poll_interval):
+            for class_name in self.batcher.detectors:
+                class_dir = os.path.join(self.watch_dir, class_name)
+                for filename in sorted(os.listdir(class_dir)):
+                    path = os.path.join(class_dir, filename)
+                    if filename.startswith('.') or not filename.lower().endswith(IMAGE_EXTENSIONS):
+                        continue
+                    with self.lock:
+                        if path in self.in_flight:
+                            continue
+                        self.in_flight.add(path)
+                    try:
+                        image = load_uint8_image(path)
+                    except Exception as e:
+                        print('cannot decode %s: %s' % (path, e))
+                        os.replace(path, os.path.join(class_dir, 'done', filename))
+                        with self.lock:
+                            self.in_flight.discard(path)
+                        continue
+                    future = self.batcher.submit(class_name, image, self.score_map)
+                    future.add_done_callback(lambda future, path=path: self._write_result(path, future))
+
+    def _write_result(self, path, future):
+        class_dir, filename = os.path.split(path)
+        stem = os.path.splitext(filename)[0]
+        try:
+            result = future.result()
+            if 'score_map' in result:
+                np.save(os.path.join(class_dir, 'results', stem + '.npy'), result.pop('score_map'))
+        except Exception as e:
+            result = {'error': str(e)}
+        with open(os.path.join(class_dir, 'results', stem + '.json'), 'w') as f:
+            json.dump(result, f)
+        os.replace(path, os.path.join(class_dir, 'done', filename))
+        with self.lock:
+            self.in_flight.discard(path)
+
+
+def load_detectors(model_dir, class_names, device, extractor):
+    """Saved detectors of each class, sharing one extractor, warmed up with one batch each"""
+    if class_names is None:
+        class_names = sorted(name for name in os.listdir(model_dir) if os.path.isdir(os.path.join(model_dir, name)))
+    detectors = {}
+    for class_name in class_names:
+        detector = SpadeDetector.load(os.path.join(model_dir, class_name), device=device, extractor=extractor)
+        detector.predict(torch.zeros(1, 3, 224, 224, dtype=torch.uint8))
+        detectors[class_name] = detector
+        print('loaded detector: %s' % class_name)
+    return detectors
+
+
+def main():
+    args = parse_args()
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if args.extractor_path is not None:
+        extractor = load_extractor(args.extractor_path, device)
+    else:
+        extractor = build_extractor(device, compile_mode=args.compile)
+    detectors = load_detectors(args.model_dir, args.class_names, device, extractor)
+    batcher = MicroBatcher(detectors, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms)
+
+    if args.unix_socket is not None:
+        if os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        server = UnixHTTPServer(args.unix_socket, RequestHandler)
+        address = args.unix_socket
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+        address = 'http://%s:%d' % (args.host, args.port)
+    server.batcher = batcher
+    watcher = DirectoryWatcher(batcher, args.watch_dir, args.poll_interval) if args.watch_dir else None
+
+    def report():
+        while True:
+            time.sleep(args.report_interval)
+            print('serve: %s' % batcher.stats.report())
+
+    threading.Thread(target=report, daemon=True).start()
+    print('serving %s on %s' % (', '.join(detectors), address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if watcher is not None:
+            watcher.close()
+        batcher.close()
+        print('serve: %s' % batcher.stats.report())
+
+
+if __name__ == '__main__':
+    main()
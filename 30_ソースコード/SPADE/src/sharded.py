@@ -0,0 +1,210 @@
+import multiprocessing as mp
+import os
+import socket
+from collections import OrderedDict
+from datetime import timedelta
+
+import torch
+import torch.distributed as dist
+
+from detector import SpadeDetector
+from feature_cache import load_features, load_meta
+from localization import LAYER_NAMES, iter_layer_score_maps
+from postprocess import postprocess
+
+
+def shard_range(n, rank, world_size):
+    """Rows [start, end) of shard rank when n rows are split in world_size contiguous parts of near-equal size"""
+    return n * rank // world_size, n * (rank + 1) // world_size
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class ShardedDetector:
+    """Scores test features against a train feature bank split across local processes
+
+    The bank in feature_dir (a feature cache, see feature_cache.py) is split into
+    n_shards contiguous ranges of train images, one per process of a gloo process
+    group on localhost. The calling process is rank 0: it holds shard 0 and
+    coordinates the others, which run shard_worker() until close(). Used as a
+    context manager, rank 0 closes the group on exit, and terminates the workers
+    if it exits on an error. Every collective fails after timeout seconds, so a
+    dead or stuck process raises an error instead of blocking the others forever.
+
+    For each batch, rank 0 broadcasts the test features and every shard answers a
+    partial top-K search over its own images. The partial results are all_gathered
+    and merged into the global top-K. Each shard then computes the nearest patch
+    distances to the global top-K images that it holds, with inf for the others.
+    An all_reduce MIN gives the distances to the whole top-K gallery, and rank 0
+    turns them into score maps. The results are those of one SpadeDetector over the
+    whole bank, while each process only reads and searches 1 / n_shards of it.
+    """
+
+    def __init__(self, feature_dir, rank, world_size, config=None, device='cpu'):
+        config = dict(config or {}, ann=False)
+        self.rank = rank
+        self.world_size = world_size
+        self.detector = SpadeDetector(device=device, **config)
+        header = load_meta(feature_dir)
+        assert header is not None, 'no feature cache in {}'.format(feature_dir)
+        train_outputs = load_features(feature_dir, dtype=header['dtype'])
+        n_train = len(train_outputs['avgpool'])
+        assert n_train >= world_size, 'cannot split {} train images in {} shards'.format(n_train, world_size)
+        # memory-mapped layers are sliced without reading them, each shard only pages in its own rows
+        self.start, self.end = shard_range(n_train, rank, world_size)
+        self.detector.train_outputs = OrderedDict((k, v[self.start:self.end]) for k, v in train_outputs.items())
+        self.detector.avgpool_index = self.detector._build_image_index(None)
+        self.shapes = OrderedDict((k, tuple(v.shape[1:])) for k, v in train_outputs.items())
+        self.workers = []
+        self.timeout = None
+
+    @classmethod
+    def start(cls, feature_dir, n_shards, config=None, device='cpu', threads_per_shard=None, timeout=120):
+        """Rank 0 of a new process group, after starting n_shards - 1 shard workers"""
+        port = free_port()
+        threads = threads_per_shard or max(1, (os.cpu_count() or 1) // n_shards)
+        ctx = mp.get_context('spawn')
+        workers = [ctx.Process(target=shard_worker, args=(feature_dir, rank, n_shards, port, config, threads,
+                                                          timeout), daemon=True) for rank in range(1, n_shards)]
+        for worker in workers:
+            worker.start()
+        try:
+            dist.init_process_group('gloo', init_method='tcp://127.0.0.1:%d' % port, rank=0, world_size=n_shards,
+                                     timeout=timedelta(seconds=timeout))
+            sharded = cls(feature_dir, 0, n_shards, config, device)
+        except BaseException:
+            terminate(workers)
+            raise
+        sharded.workers = workers
+        sharded.timeout = timeout
+        return sharded
+
+    def close(self, error=False):
+        """Stop the shard workers and destroy the process group (rank 0)
+
+        After an error the workers may wait in another collective than the stop
+        round, or be dead, so they are terminated instead of stopped. Workers that
+        do not exit within the timeout of the group are terminated as well.
+        """
+        try:
+            if not error:
+                self._step(None)
+                for worker in self.workers:
+                    worker.join(self.timeout)
+        finally:
+            terminate(self.workers)
+            dist.destroy_process_group()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(error=exc_type is not None)
+
+    def score(self, test_outputs):
+        """Image-level scores and pixel-level score maps, as SpadeDetector.score (rank 0)"""
+        return self._step(test_outputs)
+
+    def serve(self):
+        """Answer the batches of rank 0 until it closes the group (ranks > 0)"""
+        while self._step(None) is not None:
+            pass
+
+    def _step(self, test_outputs):
+        """One collective round: None on all ranks when rank 0 sends no test outputs"""
+        n = torch.tensor([0 if test_outputs is None else len(test_outputs['avgpool'])])
+        dist.broadcast(n, 0)
+        if int(n) == 0:
+            return None
+        test_outputs = self._broadcast_outputs(test_outputs, int(n))
+        scores, topk_indexes = self._image_scores(test_outputs)
+        layer_score_maps = self._layer_score_maps(test_outputs, topk_indexes)
+        if self.rank != 0:
+            return True
+        score_maps = postprocess([score_map.to(self.detector.device) for score_map in layer_score_maps])
+        return scores, list(score_maps.cpu().numpy())
+
+    def _broadcast_outputs(self, test_outputs, n):
+        outputs = OrderedDict()
+        for name, shape in self.shapes.items():
+            if self.rank == 0:
+                feat = test_outputs[name].detach().cpu().float().contiguous()
+            else:
+                feat = torch.empty((n,) + shape)
+            dist.broadcast(feat, 0)
+            outputs[name] = feat.to(self.detector.device)
+        return outputs
+
+    def _image_scores(self, test_outputs):
+        """Mean distance to the global top-K train images, and their indexes in the whole bank"""
+        k = self.detector.top_k
+        queries = torch.flatten(test_outputs['avgpool'], 1)
+        values, indexes = self.detector.avgpool_index.search(queries, min(k, self.end - self.start))
+        values, indexes = values.float().cpu(), indexes.cpu()
+        # pad to k, so that the partial results of all shards have one shape
+        pad = k - values.size(1)
+        values = torch.cat([values, values.new_full((len(values), pad), float('inf'))], 1)
+        indexes = torch.cat([indexes, indexes.new_full((len(indexes), pad), -1)], 1)
+        values = torch.where(indexes < 0, torch.full_like(values, float('inf')), values)
+        indexes = torch.where(indexes < 0, indexes, indexes + self.start)
+
+        all_values = [torch.empty_like(values) for _ in range(self.world_size)]
+        all_indexes = [torch.empty_like(indexes) for _ in range(self.world_size)]
+        dist.all_gather(all_values, values)
+        dist.all_gather(all_indexes, indexes)
+        values, order = torch.topk(torch.cat(all_values, 1), k=k, dim=1, largest=False)
+        indexes = torch.gather(torch.cat(all_indexes, 1), 1, order)
+        missing = indexes < 0
+        if missing.any():
+            # fewer than top_k neighbours were found: repeat the nearest one, as SpadeDetector.image_scores
+            indexes = torch.where(missing, indexes[:, :1], indexes)
+            values = torch.where(missing, values[:, :1], values)
+        return torch.mean(values, 1).numpy(), indexes
+
+    def _layer_score_maps(self, test_outputs, topk_indexes):
+        """Per-layer nearest patch distances (N, 1, h, w) to the top-K gallery, reduced over all shards"""
+        n = len(topk_indexes)
+        layer_score_maps = [torch.full((n, 1) + self.shapes[name][1:], float('inf')) for name in LAYER_NAMES]
+        local = (topk_indexes >= self.start) & (topk_indexes < self.end)
+        # one neighbour rank at a time, only for the test images whose neighbour of that rank is on this shard
+        for j in range(topk_indexes.size(1)):
+            rows = torch.nonzero(local[:, j]).flatten()
+            if len(rows) == 0:
+                continue
+            sub_outputs = {name: test_outputs[name][rows.to(self.detector.device)] for name in LAYER_NAMES}
+            start = 0
+            for batch_maps in iter_layer_score_maps(
+                    sub_outputs, self.detector.train_outputs,
+                    (topk_indexes[rows, j:j + 1] - self.start).to(self.detector.device),
+                    memory_budget_mb=self.detector.memory_budget_mb, dtype=getattr(torch, self.detector.dist_dtype),
+                    window_radius=self.detector.window_radius):
+                batch_rows = rows[start:start + len(batch_maps[0])]
+                start += len(batch_rows)
+                for score_maps, score_map in zip(layer_score_maps, batch_maps):
+                    score_maps[batch_rows] = torch.minimum(score_maps[batch_rows], score_map.float().cpu())
+        for score_maps in layer_score_maps:
+            dist.all_reduce(score_maps, op=dist.ReduceOp.MIN)
+        return layer_score_maps
+
+
+def terminate(workers):
+    """Terminate the shard workers that are still alive and wait for them"""
+    for worker in workers:
+        if worker.is_alive():
+            worker.terminate()
+    for worker in workers:
+        worker.join()
+
+
+def shard_worker(feature_dir, rank, world_size, port, config=None, threads=None, timeout=120):
+    """Process of shard rank > 0, answers the batches of rank 0 until it closes the group"""
+    if threads is not None:
+        torch.set_num_threads(threads)
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:%d' % port, rank=rank, world_size=world_size,
+                            timeout=timedelta(seconds=timeout))
+    ShardedDetector(feature_dir, rank, world_size, config).serve()
+    dist.destroy_process_group()
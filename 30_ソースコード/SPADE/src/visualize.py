@@ -0,0 +1,93 @@
+import multiprocessing as mp
+import os
+
+import numpy as np
+
+
+def visualize_loc_result(test_imgs, gt_mask_list, score_map_list, threshold,
+                         save_path, class_name, vis_num=5):
+    """Save a 4-panel figure (image, ground truth, predicted mask, masked image) per test image
+
+    Inputs are not modified.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    for t_idx in range(vis_num):
+        test_img = test_imgs[t_idx]
+        test_img = denormalization(test_img)
+        test_gt = gt_mask_list[t_idx].transpose(1, 2, 0).squeeze()
+        test_pred = (score_map_list[t_idx] > threshold).astype(np.float32)
+        test_pred_img = test_img.copy()
+        test_pred_img[test_pred == 0] = 0
+
+        fig_img, ax_img = plt.subplots(1, 4, figsize=(12, 4))
+        fig_img.subplots_adjust(left=0, right=1, bottom=0, top=1)
+
+        for ax_i in ax_img:
+            ax_i.axes.xaxis.set_visible(False)
+            ax_i.axes.yaxis.set_visible(False)
+
+        ax_img[0].imshow(test_img)
+        ax_img[0].title.set_text('Image')
+        ax_img[1].imshow(test_gt, cmap='gray')
+        ax_img[1].title.set_text('GroundTruth')
+        ax_img[2].imshow(test_pred, cmap='gray')
+        ax_img[2].title.set_text('Predicted mask')
+        ax_img[3].imshow(test_pred_img)
+        ax_img[3].title.set_text('Predicted anomalous image')
+
+        os.makedirs(os.path.join(save_path, 'images'), exist_ok=True)
+        fig_img.savefig(os.path.join(save_path, 'images', '%s_%03d.png' % (class_name, t_idx)), dpi=100)
+        fig_img.clf()
+        plt.close(fig_img)
+
+
+def denormalization(x):
+    mean = np.array([0.485, 0.456, 0.406])
+    std = np.array([0.229, 0.224, 0.225])
+    x = (((x.transpose(1, 2, 0) * std) + mean) * 255.).astype(np.uint8)
+    return x
+
+
+def _render_worker(queue):
+    while True:
+        job = queue.get()
+        if job is None:
+            break
+        visualize_loc_result(*job)
+
+
+class VisualizationWriter:
+    """Renders localization results in background processes fed by a bounded queue
+
+    submit() copies its inputs, so callers may reuse or modify them right away.
+    It only blocks when max_queue classes are already waiting to be rendered.
+    """
+
+    def __init__(self, n_workers=1, max_queue=4):
+        ctx = mp.get_context('spawn')
+        self.queue = ctx.Queue(maxsize=max_queue)
+        self.workers = [ctx.Process(target=_render_worker, args=(self.queue,), daemon=True)
+                        for _ in range(n_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, test_imgs, gt_mask_list, score_map_list, threshold, save_path, class_name):
+        vis_num = len(test_imgs)
+        self.queue.put(([np.array(x) for x in test_imgs], [np.array(x) for x in gt_mask_list],
+                        [np.array(x) for x in score_map_list], threshold, save_path, class_name, vis_num))
+
+    def close(self):
+        """Wait until all submitted results are rendered"""
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
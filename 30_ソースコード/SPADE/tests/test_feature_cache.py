@@ -0,0 +1,96 @@
+import os
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from feature_cache import as_tensor, load_meta, update_features  # noqa: E402
+
+
+def make_extract(features, calls):
+    """extract(indexes) over a fixed (N, C, H, W) array of per-image features"""
+    def extract(indexes):
+        calls.append(list(indexes))
+        return {'layer1': torch.from_numpy(features[indexes]),
+                'avgpool': torch.from_numpy(features[indexes, :, :1, :1])}
+    return extract
+
+
+def test_update_features_keeps_extracts_and_drops(tmp_path):
+    cache_dir = str(tmp_path / 'train')
+    features = {key: np.random.RandomState(seed).rand(4, 3, 3).astype(np.float32)
+                for seed, key in enumerate('abcde')}
+
+    def run(keys):
+        calls = []
+        stacked = np.stack([features[key] for key in keys])
+        outputs, n_extracted = update_features(cache_dir, keys, make_extract(stacked, calls))
+        np.testing.assert_array_equal(as_tensor(outputs['layer1']).numpy(), stacked)
+        return n_extracted, calls
+
+    assert run(list('abc')) == (3, [[0, 1, 2]])
+    assert run(list('abc')) == (0, [])
+    # d is new, b is dropped, a and c are kept in their new order
+    assert run(list('cad')) == (1, [[2]])
+    assert load_meta(cache_dir)['keys'] == list('cad')
+
+
+def test_update_features_empty_keys(tmp_path):
+    with pytest.raises(ValueError):
+        update_features(str(tmp_path / 'train'), [], lambda indexes: None)
+
+
+def test_update_features_int8_append_raises_scale(tmp_path):
+    cache_dir = str(tmp_path / 'train')
+    rng = np.random.RandomState(0)
+    small = rng.uniform(-1, 1, (3, 4, 3, 3)).astype(np.float32)
+    # the appended image exceeds the scale of the first channels of the cached ones
+    large = rng.uniform(-1, 1, (1, 4, 3, 3)).astype(np.float32)
+    large[:, :2] *= 10
+    update_features(cache_dir, list('abc'), make_extract(small, []), dtype='int8')
+    outputs, _ = update_features(cache_dir, list('abcd'), make_extract(np.concatenate([small, large]), []),
+                                 dtype='int8')
+
+    scale = outputs['layer1'].scale
+    np.testing.assert_allclose(scale, np.abs(np.concatenate([small, large])).max(axis=(0, 2, 3)) / 127, rtol=1e-6)
+    # no value is clipped, every value is within half a quantization step (plus one for the requantized rows)
+    error = np.abs(as_tensor(outputs['layer1']).numpy() - np.concatenate([small, large]))
+    assert (error < scale.reshape(1, -1, 1, 1) * 1.01).all()
+
+
+def test_update_features_appends_in_place(tmp_path):
+    cache_dir = str(tmp_path / 'train')
+    features = np.random.RandomState(0).rand(5, 4, 3, 3).astype(np.float32)
+    update_features(cache_dir, list('abc'), make_extract(features[:3], []))
+    inode = os.stat(os.path.join(cache_dir, 'layer1.npy')).st_ino
+
+    calls = []
+    outputs, n_extracted = update_features(cache_dir, list('abcde'), make_extract(features, calls))
+    assert (n_extracted, calls) == (2, [[3, 4]])
+    # the .npy files grew in place instead of being copied to a new cache
+    assert os.stat(os.path.join(cache_dir, 'layer1.npy')).st_ino == inode
+    np.testing.assert_array_equal(as_tensor(outputs['layer1']).numpy(), features)
+    assert load_meta(cache_dir)['layers']['layer1'] == [5, 4, 3, 3]
+
+
+def test_update_features_streams_batches(tmp_path):
+    cache_dir = str(tmp_path / 'train')
+    features = np.random.RandomState(0).rand(5, 4, 3, 3).astype(np.float32)
+    consumed = []
+
+    def extract(indexes):
+        # one batch of two images at a time, as SpadeDetector.iter_extract_dataset
+        for start in range(0, len(indexes), 2):
+            consumed.append(indexes[start:start + 2])
+            rows = features[indexes[start:start + 2]]
+            yield {'layer1': torch.from_numpy(rows), 'avgpool': torch.from_numpy(rows[:, :, :1, :1])}
+
+    outputs, n_extracted = update_features(cache_dir, list('abcde'), extract, dtype='int8', chunk_size=2)
+    assert n_extracted == 5 and consumed == [[0, 1], [2, 3], [4]]
+    scale = outputs['layer1'].scale
+    np.testing.assert_allclose(scale, features.max(axis=(0, 2, 3)) / 127, rtol=1e-6)
+    error = np.abs(as_tensor(outputs['layer1']).numpy() - features)
+    assert (error < scale.reshape(1, -1, 1, 1) * 0.51).all()
+    # the spooled float32 rows are removed
+    assert sorted(os.listdir(str(tmp_path))) == ['train']
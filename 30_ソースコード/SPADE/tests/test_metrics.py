@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+
+from metrics import HistogramScoreAccumulator, ScoreAccumulator
+
+sklearn_metrics = pytest.importorskip('sklearn.metrics')
+
+
+def random_data(seed, n=2000, tied=False):
+    rng = np.random.RandomState(seed)
+    labels = rng.rand(n) < 0.3
+    scores = rng.randn(n) + labels
+    if tied:
+        # few distinct scores, many ties across both labels
+        scores = np.round(scores * 2) / 2
+    return labels.astype(np.uint8), scores.astype(np.float32)
+
+
+def accumulate(accumulator, labels, scores, n_batches=7):
+    for batch_labels, batch_scores in zip(np.array_split(labels, n_batches), np.array_split(scores, n_batches)):
+        accumulator.update(batch_labels, batch_scores)
+    return accumulator
+
+
+@pytest.mark.parametrize('tied', [False, True])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_exact_roc_matches_sklearn(seed, tied):
+    labels, scores = random_data(seed, tied=tied)
+    metric = accumulate(ScoreAccumulator(), labels, scores)
+
+    assert metric.roc_auc() == pytest.approx(sklearn_metrics.roc_auc_score(labels, scores), abs=1e-12)
+    fpr, tpr, thresholds = metric.roc_curve()
+    ref_fpr, ref_tpr, ref_thresholds = sklearn_metrics.roc_curve(labels, scores, drop_intermediate=False)
+    np.testing.assert_allclose(fpr, ref_fpr)
+    np.testing.assert_allclose(tpr, ref_tpr)
+    np.testing.assert_array_equal(thresholds[1:], ref_thresholds[1:])
+
+
+@pytest.mark.parametrize('tied', [False, True])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_exact_pr_curve_matches_sklearn(seed, tied):
+    labels, scores = random_data(seed, tied=tied)
+    metric = accumulate(ScoreAccumulator(), labels, scores)
+
+    precision, recall, thresholds = metric.pr_curve()
+    ref_precision, ref_recall, ref_thresholds = sklearn_metrics.precision_recall_curve(labels, scores)
+    np.testing.assert_allclose(precision, ref_precision)
+    np.testing.assert_allclose(recall, ref_recall)
+    np.testing.assert_array_equal(thresholds, ref_thresholds)
+
+
+@pytest.mark.parametrize('tied', [False, True])
+def test_best_f1_threshold_matches_sklearn(tied):
+    labels, scores = random_data(3, tied=tied)
+    threshold = accumulate(ScoreAccumulator(), labels, scores).best_f1_threshold()
+
+    precision, recall, thresholds = sklearn_metrics.precision_recall_curve(labels, scores)
+    f1 = 2 * precision * recall / np.maximum(precision + recall, 1e-12)
+    best_f1 = sklearn_metrics.f1_score(labels, scores >= threshold)
+    assert best_f1 == pytest.approx(f1[:-1].max())
+
+
+@pytest.mark.parametrize('tied', [False, True])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_histogram_roc_auc_within_error_bound(seed, tied):
+    labels, scores = random_data(seed, n=20000, tied=tied)
+    # start from a narrow range, so that later batches double it several times
+    order = np.argsort(np.abs(scores), kind='mergesort')
+    labels, scores = labels[order], scores[order]
+    metric = accumulate(HistogramScoreAccumulator(n_bins=256), labels, scores, n_batches=20)
+
+    assert metric.high - metric.low > 4 * (scores[:1000].max() - scores[:1000].min())
+    assert metric.pos.sum() + metric.neg.sum() == len(scores)
+    exact = sklearn_metrics.roc_auc_score(labels, scores)
+    bound = metric.roc_auc_error_bound()
+    if not tied:
+        # with tied scores the bound also counts the exact ties, it is only loose then
+        assert bound < 0.05
+    assert abs(metric.roc_auc() - exact) <= bound + 1e-12
+
+
+def test_histogram_is_exact_at_bin_edges():
+    # scores on a grid coarser than the bins: every distinct score gets its own bin
+    labels, scores = random_data(4, tied=True)
+    metric = accumulate(HistogramScoreAccumulator(n_bins=4096, score_range=(-8., 8.)), labels, scores)
+
+    assert metric.roc_auc() == pytest.approx(sklearn_metrics.roc_auc_score(labels, scores), abs=1e-12)
+
+
+@pytest.mark.parametrize('accumulator', [ScoreAccumulator, HistogramScoreAccumulator])
+@pytest.mark.parametrize('label', [0, 1])
+def test_single_class(accumulator, label):
+    scores = np.random.RandomState(5).rand(100).astype(np.float32)
+    metric = accumulate(accumulator(), np.full(100, label), scores)
+
+    assert np.isnan(metric.roc_auc())
+    fpr, tpr, _ = metric.roc_curve()
+    assert np.all(np.isfinite(fpr)) and np.all(np.isfinite(tpr))
+    assert np.isfinite(metric.best_f1_threshold())
+
+
+@pytest.mark.parametrize('accumulator', [ScoreAccumulator, HistogramScoreAccumulator])
+def test_constant_scores(accumulator):
+    labels = np.arange(100) % 2
+    metric = accumulate(accumulator(), labels, np.ones(100, dtype=np.float32))
+
+    assert metric.roc_auc() == pytest.approx(0.5)
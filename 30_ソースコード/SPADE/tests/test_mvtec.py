@@ -0,0 +1,97 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('PIL')
+
+import datasets.mvtec as mvtec  # noqa: E402
+from datasets.synthetic import make_synthetic_mvtec  # noqa: E402
+
+
+@pytest.fixture
+def class_path(tmp_path):
+    class_path = make_synthetic_mvtec(str(tmp_path), 'bottle', n_train=3, n_test_good=2, n_test_defect=4, size=32)
+    os.remove(os.path.join(class_path, mvtec.MARKER_FILENAME))
+    return class_path
+
+
+def download(class_path, verify=False):
+    """MVTecDataset.download for the class folder, without building a dataset"""
+    mvtec_folder_path, class_name = os.path.split(class_path)
+    mvtec.MVTecDataset.download(SimpleNamespace(mvtec_folder_path=mvtec_folder_path, class_name=class_name,
+                                                verify=verify, archive_sha256=None))
+
+
+def fail_download(monkeypatch):
+    def download_url(url, output_path):
+        raise RuntimeError('download')
+
+    monkeypatch.setattr(mvtec, 'download_url', download_url)
+
+
+def test_complete_folder(class_path):
+    assert mvtec.check_structure(class_path) == []
+
+
+@pytest.mark.parametrize('damage', ['mask', 'tmp', 'empty', 'train'])
+def test_incomplete_folder(class_path, damage):
+    if damage == 'mask':
+        os.remove(os.path.join(class_path, 'ground_truth', 'blob', '000_mask.png'))
+    elif damage == 'tmp':
+        open(os.path.join(class_path, 'test', 'good', '001.png.tmp'), 'wb').close()
+    elif damage == 'empty':
+        open(os.path.join(class_path, 'test', 'scratch', '000.png'), 'wb').close()
+    else:
+        for filename in os.listdir(os.path.join(class_path, 'train', 'good')):
+            os.remove(os.path.join(class_path, 'train', 'good', filename))
+    assert len(mvtec.check_structure(class_path)) == 1
+
+
+def test_prestaged_folder_gets_marker(class_path):
+    download(class_path)
+    assert mvtec.check_marker(class_path)
+
+
+def test_incomplete_prestaged_folder_is_not_marked(class_path, monkeypatch):
+    os.remove(os.path.join(class_path, 'ground_truth', 'scratch', '001_mask.png'))
+    fail_download(monkeypatch)
+    with pytest.raises(RuntimeError, match='download'):
+        download(class_path)
+    assert not os.path.exists(os.path.join(class_path, mvtec.MARKER_FILENAME))
+
+
+@pytest.mark.parametrize('verify', [False, True])
+def test_corrupt_marked_folder_is_not_marked_again(class_path, monkeypatch, verify):
+    download(class_path)
+    path = os.path.join(class_path, 'train', 'good', '001.png')
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        # truncated, or the same size with other content, which only the sha256 check finds
+        f.write(data[:len(data) // 2] if not verify else bytes(len(data)))
+    fail_download(monkeypatch)
+    with pytest.raises(RuntimeError, match='download'):
+        download(class_path, verify=verify)
+    assert not os.path.exists(os.path.join(class_path, mvtec.MARKER_FILENAME))
+    assert not os.path.exists(path)
+
+
+def test_build_cache_removes_older_caches(tmp_path):
+    make_synthetic_mvtec(str(tmp_path), 'bottle', n_train=3, n_test_good=2, n_test_defect=4, size=32)
+    cache_dir = str(tmp_path / 'cache')
+
+    def build():
+        dataset = mvtec.MVTecDataset(root_path=str(tmp_path), class_name='bottle', is_train=True, resize=32,
+                                     cropsize=28, cache_dir=cache_dir)
+        return sorted(os.path.basename(path) for path in [dataset.cache_x_path, dataset.cache_mask_path])
+
+    first = build()
+    assert sorted(os.listdir(cache_dir)) == first
+    # a changed mtime gives a new cache key
+    path = os.path.join(str(tmp_path), 'mvtec_anomaly_detection', 'bottle', 'train', 'good', '000.png')
+    os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 10 ** 9))
+    second = build()
+    assert second != first
+    assert sorted(os.listdir(cache_dir)) == second
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+ndimage = pytest.importorskip('scipy.ndimage')
+
+from postprocess import gaussian_blur, reflect_pad  # noqa: E402
+
+# sigma=4 has a kernel radius of 16: the smaller maps are reflected several times
+SIZES = [(1, 1), (3, 5), (7, 20), (16, 17), (33, 40), (56, 56), (224, 224)]
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_gaussian_blur_matches_scipy(size):
+    maps = np.random.RandomState(0).rand(2, *size)
+    smoothed = gaussian_blur(torch.from_numpy(maps), sigma=4).numpy()
+    for score_map, ref_map in zip(smoothed, maps):
+        np.testing.assert_allclose(score_map, ndimage.gaussian_filter(ref_map, sigma=4, mode='reflect'),
+                                   rtol=1e-10, atol=1e-12)
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_gaussian_blur_float32(size):
+    maps = np.random.RandomState(1).rand(2, *size).astype(np.float32)
+    smoothed = gaussian_blur(torch.from_numpy(maps), sigma=4).numpy()
+    for score_map, ref_map in zip(smoothed, maps):
+        np.testing.assert_allclose(score_map, ndimage.gaussian_filter(ref_map.astype(np.float64), sigma=4),
+                                   rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize('n, pad', [(1, 3), (3, 1), (3, 3), (3, 5), (4, 16), (5, 16)])
+def test_reflect_pad_matches_numpy_symmetric(n, pad):
+    # scipy.ndimage mode='reflect' is numpy mode='symmetric'
+    x = np.arange(n, dtype=np.float64)
+    padded = reflect_pad(torch.from_numpy(x).view(1, -1), pad, 1).view(-1).numpy()
+    np.testing.assert_array_equal(padded, np.pad(x, pad, mode='symmetric'))
@@ -0,0 +1,74 @@
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+dist = pytest.importorskip('torch.distributed')
+
+from detector import SpadeDetector  # noqa: E402
+from feature_cache import load_features, save_features  # noqa: E402
+import sharded as sharded_module  # noqa: E402
+from sharded import ShardedDetector, shard_range  # noqa: E402
+
+needs_gloo = pytest.mark.skipif(not dist.is_available() or not dist.is_gloo_available(),
+                                reason='gloo backend is not available')
+SHAPES = OrderedDict([('layer1', (4, 8, 8)), ('layer2', (6, 4, 4)), ('layer3', (8, 2, 2)), ('avgpool', (8, 1, 1))])
+
+
+def random_outputs(n, seed):
+    generator = torch.Generator().manual_seed(seed)
+    return OrderedDict((name, torch.rand((n,) + shape, generator=generator)) for name, shape in SHAPES.items())
+
+
+def test_shard_range_covers_all_rows():
+    for n, world_size in [(7, 2), (10, 3), (4, 4)]:
+        ranges = [shard_range(n, rank, world_size) for rank in range(world_size)]
+        assert ranges[0][0] == 0 and ranges[-1][1] == n
+        assert all(end == start for (_, end), (start, _) in zip(ranges, ranges[1:]))
+
+
+@pytest.fixture
+def feature_dir(tmp_path):
+    # 7 train images are split in shards of 3 and 4
+    feature_dir = str(tmp_path / 'bank')
+    save_features(feature_dir, random_outputs(7, seed=0))
+    return feature_dir
+
+
+@needs_gloo
+def test_two_shards_match_one_detector(feature_dir):
+    # top_k = 5 needs neighbours from both shards
+    detector = SpadeDetector(top_k=5, device='cpu')
+    detector.train_outputs = load_features(feature_dir)
+
+    with ShardedDetector.start(feature_dir, 2, detector.config(), threads_per_shard=1) as sharded:
+        for seed in [1, 2]:
+            test_outputs = random_outputs(3, seed)
+            scores, score_maps = sharded.score(test_outputs)
+            expected_scores, expected_score_maps = detector.score(test_outputs)
+            np.testing.assert_allclose(scores, expected_scores, rtol=1e-5, atol=1e-6)
+            np.testing.assert_allclose(np.stack(score_maps), np.stack(expected_score_maps), rtol=1e-5, atol=1e-6)
+
+
+@needs_gloo
+def test_error_in_score_terminates_the_workers(feature_dir, monkeypatch):
+    def iter_layer_score_maps(*args, **kwargs):
+        raise RuntimeError('localization')
+
+    # only rank 0 fails, after the image-level collectives, while the other shard waits in all_reduce
+    monkeypatch.setattr(sharded_module, 'iter_layer_score_maps', iter_layer_score_maps)
+    with pytest.raises(RuntimeError, match='localization'):
+        with ShardedDetector.start(feature_dir, 2, {'top_k': 5}, threads_per_shard=1, timeout=10) as sharded:
+            sharded.score(random_outputs(3, seed=1))
+    assert not any(worker.is_alive() for worker in sharded.workers)
+
+
+@needs_gloo
+def test_dead_worker_fails_the_score(feature_dir):
+    with pytest.raises(RuntimeError):
+        with ShardedDetector.start(feature_dir, 2, {'top_k': 5}, threads_per_shard=1, timeout=10) as sharded:
+            sharded.workers[0].terminate()
+            sharded.workers[0].join()
+            sharded.score(random_outputs(3, seed=1))
+    assert not any(worker.is_alive() for worker in sharded.workers)